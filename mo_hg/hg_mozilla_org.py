@@ -66,6 +66,7 @@ class HgMozillaOrg(object):
         branches=None,  # CONNECTION INFO FOR ES CACHE
         use_cache=False,   # True IF WE WILL USE THE ES FOR DOWNLOADING BRANCHES
         timeout=30 * SECOND,
+        pushlog_threads=4,  # MAXIMUM CONCURRENT PUSHLOG REQUESTS MADE BY get_revisions()
         kwargs=None
     ):
         if not _hg_branches:
@@ -73,6 +74,9 @@ class HgMozillaOrg(object):
 
         self.settings = kwargs
         self.timeout = Duration(timeout)
+        self.pushlog_threads = pushlog_threads
+        self.revision_locker = Lock("revision cache")
+        self.revision_cache = {}  # MAP FROM (id12, branch, locale) TO (timeout, revision, exception)
 
         if branches == None:
             self.branches = _hg_branches.get_branches(kwargs=kwargs)
@@ -127,6 +131,10 @@ class HgMozillaOrg(object):
         elif revision.branch.name == None:
             return Null
         locale = coalesce(locale, revision.branch.locale, DEFAULT_LOCALE)
+        found, doc = self._get_from_cache(rev, revision.branch.name, locale)
+        if found:
+            return doc
+
         doc = self._get_from_elasticsearch(revision, locale=locale)
         if doc:
             Log.note("Got hg ({{branch}}, {{locale}}, {{revision}}) from ES", branch=doc.branch.name, locale=locale, revision=doc.changeset.id)
@@ -135,6 +143,112 @@ class HgMozillaOrg(object):
         output = self._load_all_in_push(revision, locale=locale)
         return output
 
+    def get_revisions(self, revisions, locale=None, please_stop=False):
+        """
+        EXPECTING MANY INCOMPLETE revisions
+        RESOLVE THEM ALL INTO THE CACHE USED BY get_revision():  ONE ES QUERY
+        FOR THE LOT, AND ONLY THE MISSES ARE PULLED FROM hg
+        """
+        pending = {}
+        for r in revisions:
+            rev = r.changeset.id
+            if not rev or rev == "None" or r.branch.name == None:
+                continue
+            key = (rev[0:12], r.branch.name, coalesce(locale, r.branch.locale, DEFAULT_LOCALE))
+            if key not in pending and not self._in_cache(key):
+                pending[key] = r
+        if not pending:
+            return
+
+        # ONE ES QUERY FOR ALL REVISIONS
+        if self.es:
+            try:
+                for _, keys in jx.groupby(list(pending.keys()), size=1000):
+                    if not keys:
+                        continue
+                    docs = self.es.search({
+                        "query": {"filtered": {
+                            "query": {"match_all": {}},
+                            "filter": {"and": [
+                                {"terms": {"changeset.id12": list(set(k[0] for k in keys))}},
+                                {"terms": {"branch.name": list(set(k[1] for k in keys))}},
+                                {"terms": {"branch.locale": list(set(k[2] for k in keys))}}
+                            ]}
+                        }},
+                        "size": 10000
+                    }).hits.hits
+                    for d in docs:
+                        self._add_to_cache(d._source)
+            except Exception, e:
+                Log.warning("Bad ES call, fall back to hg", cause=e)
+
+        misses = [(k, r) for k, r in pending.items() if not self._in_cache(k)]
+        Log.note("Resolved {{num}} revisions from ES, {{misses}} left for hg", num=len(pending) - len(misses), misses=len(misses))
+        if not misses:
+            return
+
+        # PULL THE MISSES FROM hg, WITH LIMITED CONCURRENCY
+        queue = Queue("revisions", max=len(misses) + 1, silent=True)
+        queue.extend(misses)
+        queue.add(THREAD_STOP)
+
+        def _load(please_stop):
+            for key, revision in queue:
+                if please_stop:
+                    return
+                if self._in_cache(key):
+                    # PULLED WITH AN EARLIER PUSH
+                    continue
+                try:
+                    doc = self._load_all_in_push(revision, locale=key[2])
+                    self._set_cache(key, doc, None)
+                except Exception, e:
+                    self._set_cache(key, None, Except.wrap(e))
+
+        threads = [
+            Thread.run("get revisions " + unicode(i), _load, please_stop=please_stop)
+            for i in range(min(self.pushlog_threads, len(misses)))
+        ]
+        for t in threads:
+            with assert_no_exception:
+                t.join()
+
+    def _in_cache(self, key):
+        with self.revision_locker:
+            timeout = self.revision_cache.get(key, (None, None, None))[0]
+            return timeout != None and timeout >= Date.now()
+
+    def _get_from_cache(self, rev, branch, locale):
+        """
+        :return: (found, revision) PAIR;  RAISE THE CACHED EXCEPTION, IF ANY
+        """
+        key = (rev[0:12], branch, locale)
+        with self.revision_locker:
+            timeout, doc, exception = self.revision_cache.get(key, (None, None, None))
+            if timeout == None:
+                return False, None
+            if timeout < Date.now():
+                del self.revision_cache[key]
+                return False, None
+        if exception:
+            raise exception
+        return True, doc
+
+    def _set_cache(self, key, doc, exception):
+        with self.revision_locker:
+            if Random.int(1000) == 0:
+                # REMOVE OLD CACHE
+                now = Date.now()
+                self.revision_cache = {k: v for k, v in self.revision_cache.items() if v[0] > now}
+            self.revision_cache[key] = (Date.now() + HOUR, doc, exception)
+
+    def _add_to_cache(self, doc):
+        self._set_cache(
+            (doc.changeset.id[0:12], doc.branch.name, coalesce(doc.branch.locale, DEFAULT_LOCALE)),
+            doc,
+            None
+        )
+
     def _get_from_elasticsearch(self, revision, locale=None):
         rev = revision.changeset.id
         query = {
@@ -247,6 +361,8 @@ class HgMozillaOrg(object):
                         _id = coalesce(rev.changeset.id12, "") + "-" + rev.branch.name + "-" + coalesce(rev.branch.locale, DEFAULT_LOCALE)
                         revs.append({"id": _id, "value": rev})
             self.es.extend(revs)
+            for r in revs:
+                self._add_to_cache(r["value"])
             return output
 
     def _get_and_retry(self, url, branch, **kwargs):
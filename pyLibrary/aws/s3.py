@@ -14,6 +14,7 @@ from __future__ import unicode_literals
 import StringIO
 import gzip
 import zipfile
+from mmap import mmap
 from tempfile import TemporaryFile
 
 import boto
@@ -23,11 +24,12 @@ from boto.s3.connection import Location
 from mo_dots import wrap, Null, coalesce, unwrap, Data
 from mo_kwargs import override
 from mo_logs import Log, Except
+from mo_threads import Queue, Signal, Thread, THREAD_STOP
 from mo_times.dates import Date
 from mo_times.timer import Timer
 from pyLibrary import convert
 from pyLibrary.env import http
-from pyLibrary.env.big_data import safe_size, MAX_STRING_SIZE, LazyLines, ibytes2ilines, scompressed2ibytes
+from pyLibrary.env.big_data import safe_size, MAX_STRING_SIZE, LazyLines, ibytes2ilines, scompressed2ibytes, icompressed2ibytes
 
 TOO_MANY_KEYS = 1000 * 1000 * 1000
 READ_ERROR = "S3 read error"
@@ -120,6 +122,9 @@ class Bucket(object):
         region=None,  # NAME OF AWS REGION, REQUIRED FOR SOME BUCKETS
         public=False,
         debug=False,
+        download_threads=4,  # NUMBER OF RANGES OF A BIG KEY TO DOWNLOAD AT ONCE
+        download_chunk=8 * 1024 * 1024,  # BYTES IN EACH RANGE
+        parallel_size=64 * 1024 * 1024,  # SMALLER KEYS ARE READ AS ONE STREAM
         kwargs=None
     ):
         self.settings = kwargs
@@ -278,6 +283,13 @@ class Bucket(object):
             else:
                 return convert.utf82unicode(source.read()).split("\n")
 
+        if self.settings.download_threads > 1 and source.size >= self.settings.parallel_size:
+            chunks = _parallel_download(source, self.settings.download_chunk, self.settings.download_threads)
+            if source.key.endswith(".gz"):
+                return LazyLines(ibytes2ilines(icompressed2ibytes(chunks)))
+            else:
+                return LazyLines(ibytes2ilines(chunks))
+
         if source.key.endswith(".gz"):
             return LazyLines(ibytes2ilines(scompressed2ibytes(source)))
         else:
@@ -460,6 +472,68 @@ class PublicBucket(object):
         return http.get(url).all_lines
 
 
+def _parallel_download(source, chunk_size, num_threads):
+    """
+    DOWNLOAD source IN chunk_size RANGES, num_threads AT A TIME, INTO A SPOOL FILE
+    :param source: boto Key
+    :return: GENERATOR OF THE BYTES, IN ORDER, AS SOON AS THEY ARRIVE
+    """
+    size = source.size
+    num_chunks = (size + chunk_size - 1) // chunk_size
+    spool = TemporaryFile()
+    spool.truncate(size)
+    buff = mmap(spool.fileno(), size)
+    ready = [Signal() for _ in range(num_chunks)]
+    errors = [None] * num_chunks
+
+    todo = Queue("ranges of " + source.name, max=num_chunks + num_threads)
+    todo.extend(range(num_chunks))
+    for _ in range(num_threads):
+        todo.add(THREAD_STOP)
+
+    def download(please_stop):
+        # EACH THREAD HAS ITS OWN Key, THEY ARE NOT THREAD SAFE
+        key = source.bucket.new_key(source.name)
+        for i in todo:
+            if please_stop:
+                return
+            start = i * chunk_size
+            end = min(start + chunk_size, size)
+            for attempt in range(3):
+                try:
+                    data = key.get_contents_as_string(headers={"Range": "bytes=" + unicode(start) + "-" + unicode(end - 1)})
+                    if len(data) != end - start:
+                        Log.error("Expecting {{expected}} bytes, got {{num}}", expected=end - start, num=len(data))
+                    buff[start:end] = data
+                    break
+                except Exception as e:
+                    errors[i] = Except.wrap(e)
+            else:
+                ready[i].go()
+                return
+            errors[i] = None
+            ready[i].go()
+
+    please_stop = Signal()
+    threads = [
+        Thread.run("download " + source.name + " " + unicode(i), download, please_stop=please_stop)
+        for i in range(num_threads)
+    ]
+    try:
+        for i in range(num_chunks):
+            ready[i].wait()
+            if errors[i]:
+                Log.error(READ_ERROR, cause=errors[i])
+            for start in range(i * chunk_size, min((i + 1) * chunk_size, size), MAX_STRING_SIZE):
+                yield buff[start:min(start + MAX_STRING_SIZE, (i + 1) * chunk_size, size)]
+    finally:
+        please_stop.go()
+        for t in threads:
+            t.join()
+        buff.close()
+        spool.close()
+
+
 def strip_extension(key):
     e = key.find(".json")
     if e == -1:
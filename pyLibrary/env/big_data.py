@@ -15,6 +15,7 @@ from io import BytesIO
 from tempfile import TemporaryFile
 import zipfile
 import zlib
+from time import time
 
 from mo_logs.exceptions import suppress_exception
 from mo_logs import Log
@@ -26,6 +27,7 @@ from mo_math import Math
 DEBUG = False
 MIN_READ_SIZE = 8 * 1024
 MAX_STRING_SIZE = 1 * 1024 * 1024
+ZIP_CHUNK_SIZE = 64 * 1024
 
 class FileString(object):
     """
@@ -355,6 +357,44 @@ def icompressed2ibytes(source):
         yield data
 
 
+def ibytes2icompressed(source, level=6, stats=None):
+    """
+    :param source: BYTES (str OR bytearray), OR GENERATOR OF BYTES
+    :param level: zlib COMPRESSION LEVEL, 1 (FAST) TO 9 (SMALL)
+    :param stats: OPTIONAL OBJECT WITH add(raw, compressed, seconds), CALLED WHEN DONE
+    :return: GENERATOR OF GZIP BYTES
+    """
+    if isinstance(source, (str, bytearray)):
+        source = _ichunks(source, ZIP_CHUNK_SIZE)
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    raw_count = 0
+    compressed_count = 0
+    seconds = 0
+    for bytes_ in source:
+        start = time()
+        data = compressor.compress(bytes_)
+        seconds += time() - start
+        raw_count += len(bytes_)
+        if data:
+            compressed_count += len(data)
+            yield data
+
+    start = time()
+    data = compressor.flush()
+    seconds += time() - start
+    compressed_count += len(data)
+    if stats is not None:
+        stats.add(raw_count, compressed_count, seconds)
+    yield data
+
+
+def _ichunks(bytes_, size):
+    # buffer() DOES NOT COPY THE BYTES
+    for i in range(0, len(bytes_), size):
+        yield buffer(bytes_, i, size)
+
+
 def scompressed2ibytes(stream):
     """
     :param stream:  SOMETHING WITH read() METHOD TO GET MORE BYTES
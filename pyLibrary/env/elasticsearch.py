@@ -13,16 +13,19 @@ from __future__ import unicode_literals
 
 import re
 from collections import Mapping
+from contextlib import contextmanager
 from copy import deepcopy
+from time import time
 
 import mo_json
+from mo_json import stream, quote
 from mo_logs import Log, strings
 from mo_logs.exceptions import Except
 from mo_logs.strings import utf82unicode
 from mo_threads import Lock
 from mo_dots import coalesce, Null, Data, set_default, join_field, split_field, listwrap, literal_field, \
     ROOT_PATH
-from mo_dots import wrap
+from mo_dots import wrap, unwrap
 from mo_dots.lists import FlatList
 from pyLibrary import convert
 from pyLibrary.env import http
@@ -40,6 +43,7 @@ ES_STRUCT = ["object", "nested"]
 ES_NUMERIC_TYPES = ["long", "integer", "double", "float"]
 ES_PRIMITIVE_TYPES = ["string", "boolean", "integer", "date", "long", "double"]
 INDEX_DATE_FORMAT = "%Y%m%d_%H%M%S"
+MAX_RESULT_WINDOW = 10000  # ES 2.1+ REFUSES from + size BEYOND THIS (index.max_result_window), USE scroll()
 
 
 class Features(object):
@@ -74,6 +78,9 @@ class Index(Features):
         consistency="one",  # ES WRITE CONSISTENCY (https://www.elastic.co/guide/en/elasticsearch/reference/1.7/docs-index_.html#index-consistency)
         debug=False,  # DO NOT SHOW THE DEBUG STATEMENTS
         cluster=None,
+        adaptive_batch=None,  # {"target_bytes", "target_seconds", "min_size", "max_size"} TO LEARN A GOOD BULK SIZE
+        retry_items=5,  # TIMES extend() RESENDS THE ITEMS ES WAS TOO BUSY FOR
+        dead_letter=None,  # {"file": path} OR {"host", "port", "index"} FOR THE DOCUMENTS ES WILL NOT ACCEPT
         kwargs=None
     ):
         if index==None:
@@ -84,6 +91,14 @@ class Index(Features):
         self.cluster_state = None
         self.debug = debug
         self.settings = kwargs
+        if adaptive_batch:
+            self.adaptive_batch = AdaptiveBatchSize(name=index, kwargs=adaptive_batch)
+        else:
+            self.adaptive_batch = None
+        if dead_letter:
+            self.dead_letter = DeadLetter(kwargs=dead_letter)
+        else:
+            self.dead_letter = None
         if cluster:
             self.cluster = cluster
         else:
@@ -98,11 +113,8 @@ class Index(Features):
                 Log.error("not allowed")
             if type == None:
                 # NO type PROVIDED, MAYBE THERE IS A SUITABLE DEFAULT?
-                with self.cluster.metadata_locker:
-                    index_ = self.cluster._metadata.indices[self.settings.index]
-                if not index_:
-                    indices = self.cluster.get_metadata().indices
-                    index_ = indices[self.settings.index]
+                # get_metadata() ONLY ASKS THE CLUSTER IF index IS NOT CACHED
+                index_ = self.cluster.get_metadata(index=self.settings.index).indices[self.settings.index]
 
                 candidate_types = list(index_.mappings.keys())
                 if len(candidate_types) != 1:
@@ -126,12 +138,11 @@ class Index(Features):
 
     def get_schema(self, retry=True):
         if self.settings.explore_metadata:
-            metadata = self.cluster.get_metadata()
+            metadata = self.cluster.get_metadata(force=not retry, index=self.settings.index)
             index = metadata.indices[self.settings.index]
 
             if index == None and retry:
                 #TRY AGAIN, JUST IN CASE
-                self.cluster.cluster_state = None
                 return self.get_schema(retry=False)
 
             if not index.mappings[self.settings.type]:
@@ -181,8 +192,8 @@ class Index(Features):
 
         # WAIT FOR ALIAS TO APPEAR
         while True:
-            response = self.cluster.get("/_cluster/state", retry={"times": 5}, timeout=3)
-            if alias in response.metadata.indices[self.settings.index].aliases:
+            metadata = self.cluster.get_metadata(force=True, index=self.settings.index)
+            if alias in metadata.indices[self.settings.index].aliases:
                 return
             Log.note("Waiting for alias {{alias}} to appear", alias=alias)
             Till(seconds=1).wait()
@@ -232,7 +243,6 @@ class Index(Features):
     def delete_record(self, filter):
         if self.settings.read_only:
             Log.error("Index opened in read only mode, no changes allowed")
-        self.cluster.get_metadata()
 
         if self.cluster.cluster_state.version.number.startswith("0.90"):
             query = {"filtered": {
@@ -245,7 +255,18 @@ class Index(Features):
                 "filter": filter
             }}}
         else:
-            raise NotImplementedError
+            # NO DELETE-BY-QUERY, FIND THE ids AND DELETE THEM IN BULK
+            pages = self.scroll({
+                "query": {"filtered": {
+                    "query": {"match_all": {}},
+                    "filter": filter
+                }},
+                "_source": False,
+                "size": 1000
+            })
+            for hits in pages:
+                self.delete_ids([h._id for h in hits])
+            return
 
         if self.debug:
             Log.note("Delete bugs:\n{{query}}",  query= query)
@@ -268,96 +289,197 @@ class Index(Features):
             [{"value":value}, ... {"value":value}] OR
             [{"json":json}, ... {"json":json}]
             OPTIONAL "id" PROPERTY IS ALSO ACCEPTED
+            json MAY BE utf8 ENCODED BYTES, WHICH ARE SENT UNTOUCHED
+
+        ITEMS ES REJECTS FOR BEING BUSY (429, 503) ARE SENT AGAIN, UP TO
+        retry_items TIMES.  ITEMS THAT STILL FAIL GO TO THE dead_letter, IF
+        THERE IS ONE, OTHERWISE THEY RAISE AN ERROR
+
+        :return: {"ok": NUMBER INSERTED, "retried": NUMBER OF RESENDS, "failed": LIST OF {"id", "status", "error"}}
         """
         if self.settings.read_only:
             Log.error("Index opened in read only mode, no changes allowed")
-        lines = []
-        try:
-            for r in records:
-                id = r.get("id")
-                r_value = r.get('value')
-                if id == None and r_value:
-                    id = r_value.get('_id')
-                if id == None:
-                    id = random_id()
-
-                if "json" in r:
-                    json_bytes = r["json"].encode("utf8")
-                elif r_value or isinstance(r_value, (dict, Data)):
-                    json_bytes = convert.value2json(r_value).encode("utf8")
-                else:
-                    json_bytes = None
-                    Log.error("Expecting every record given to have \"value\" or \"json\" property")
 
-                lines.append(b'{"index":{"_id": ' + convert.value2json(id).encode("utf8") + b'}}')
-                if self.settings.tjson:
-                    lines.append(json2typed(json_bytes.decode('utf8')).encode('utf8'))
-                else:
-                    lines.append(json_bytes)
+        try:
+            data_bytes, ids, spans = self._bulk_body(records)
             del records
+            return self._bulk(data_bytes, ids, spans)
+        except Exception as e:
+            Log.error("problem sending to ES", e)
 
-            if not lines:
-                return
+    def update(self, records, upsert=False):
+        """
+        PARTIAL UPDATE OF EXISTING DOCUMENTS, IN BULK
+        records - MUST HAVE FORM OF
+            [{"id":id, "value":value}, ... ] OR
+            [{"id":id, "json":json}, ... ]
+            WHERE THE value (OR json) IS MERGED INTO THE EXISTING DOCUMENT
+        :param upsert: True TO INSERT THE value WHEN THERE IS NO DOCUMENT
+        :return: SAME AS extend()
+        """
+        if self.settings.read_only:
+            Log.error("Index opened in read only mode, no changes allowed")
 
-            with Timer("Add {{num}} documents to {{index}}", {"num": len(lines) / 2, "index":self.settings.index}, debug=self.debug):
-                try:
-                    data_bytes = b"\n".join(l for l in lines) + b"\n"
-                except Exception as e:
-                    Log.error("can not make request body from\n{{lines|indent}}", lines=lines, cause=e)
-
-                response = self.cluster.post(
-                    self.path + "/_bulk",
-                    data=data_bytes,
-                    headers={"Content-Type": "text"},
-                    timeout=self.settings.timeout,
-                    retry=self.settings.retry,
-                    params={"consistency": self.settings.consistency}
-                )
-                items = response["items"]
-
-                fails = []
-                if self.cluster.version.startswith("0.90."):
-                    for i, item in enumerate(items):
-                        if not item.index.ok:
-                            fails.append(i)
-                elif any(map(self.cluster.version.startswith, ["1.4.", "1.5.", "1.6.", "1.7."])):
-                    for i, item in enumerate(items):
-                        if item.index.status not in [200, 201]:
-                            fails.append(i)
-                else:
-                    Log.error("version not supported {{version}}", version=self.cluster.version)
-
-                if fails:
-                    if len(fails) <= 3:
-                        cause = [
-                            Except(
-                                template="{{status}} {{error}} (and {{some}} others) while loading line id={{id}} into index {{index|quote}}:\n{{line}}",
-                                status=items[i].index.status,
-                                error=items[i].index.error,
-                                some=len(fails) - 1,
-                                line=strings.limit(lines[i * 2 + 1], 500 if not self.debug else 100000),
-                                index=self.settings.index,
-                                id=items[i].index._id
-                            )
-                            for i in fails
-                        ]
-                    else:
-                        i=fails[0]
-                        cause = Except(
-                            template="{{status}} {{error}} (and {{some}} others) while loading line id={{id}} into index {{index|quote}}:\n{{line}}",
-                            status=items[i].index.status,
-                            error=items[i].index.error,
-                            some=len(fails) - 1,
-                            line=strings.limit(lines[i * 2 + 1], 500 if not self.debug else 100000),
-                            index=self.settings.index,
-                            id=items[i].index._id
-                        )
-                    Log.error("Problems with insert", cause=cause)
+        try:
+            return self._bulk(*self._bulk_body(records, action="update", upsert=upsert))
+        except Exception as e:
+            Log.error("problem sending updates to ES", e)
 
+    def delete_ids(self, ids):
+        """
+        DELETE DOCUMENTS, IN BULK;  MISSING DOCUMENTS ARE NOT AN ERROR
+        :return: SAME AS extend()
+        """
+        if self.settings.read_only:
+            Log.error("Index opened in read only mode, no changes allowed")
+
+        try:
+            data_bytes = bytearray()
+            spans = []
+            ids = list(ids)
+            for id in ids:
+                action = len(data_bytes)
+                data_bytes += b'{"delete":{"_id":' + _id2bytes(id) + b'}}'
+                spans.append((action, action, len(data_bytes)))
+                data_bytes += b'\n'
+            return self._bulk(data_bytes, ids, spans, ok_status=[200, 404])
         except Exception as e:
-            if e.message.startswith("sequence item "):
-                Log.error("problem with {{data}}", data=repr(lines[int(e.message[14:16].strip())]), cause=e)
-            Log.error("problem sending to ES", e)
+            Log.error("problem sending deletes to ES", e)
+
+    def _bulk(self, data_bytes, ids, spans, ok_status=(200, 201)):
+        """
+        SEND THE BULK BODY, AND SEND AGAIN THE ITEMS ES WAS TOO BUSY FOR
+        :param ok_status: THE ITEM STATUS THAT COUNT AS SUCCESS
+        :return: {"ok", "retried", "failed"}
+        """
+        output = Data(ok=0, retried=0, failed=[])
+        if not ids:
+            return output
+
+        positions = range(len(ids))  # WHERE EACH ITEM WAS IN THE ORIGINAL REQUEST
+        backoff = 1
+        for attempt in range(self.settings.retry_items + 1):
+            items = self._bulk_post(data_bytes, len(ids))
+
+            retry = []
+            for i, item in enumerate(items):
+                status, error = _item_status(item)
+                if status in ok_status:
+                    output.ok += 1
+                elif status in RETRY_STATUS and attempt < self.settings.retry_items:
+                    retry.append(i)
+                else:
+                    output.failed.append({
+                        "position": positions[i],
+                        "id": ids[i],
+                        "status": status,
+                        "error": error,
+                        "line": _span(data_bytes, spans[i])
+                    })
+            if not retry:
+                break
+
+            # ONLY THE REJECTED ITEMS ARE SENT AGAIN
+            output.retried += len(retry)
+            Log.note(
+                "ES is busy; {{num}} of {{total}} documents will be sent to {{index}} again in {{seconds}} seconds",
+                num=len(retry),
+                total=len(items),
+                index=self.settings.index,
+                seconds=backoff
+            )
+            Till(seconds=backoff).wait()
+            backoff = Math.min(backoff * 2, MAX_BACKOFF)
+            data_bytes, spans = _bulk_subset(data_bytes, spans, retry)
+            ids = [ids[i] for i in retry]
+            positions = [positions[i] for i in retry]
+
+        if output.failed:
+            if self.dead_letter:
+                Log.warning("{{num}} documents sent to dead letter", num=len(output.failed))
+                self.dead_letter.extend(self.settings.index, output.failed)
+            else:
+                self._insert_problem(output.failed)
+        return output
+
+    def _bulk_body(self, records, action="index", upsert=False):
+        """
+        THE BULK BODY IS WRITTEN STRAIGHT INTO ONE BUFFER
+        :param action: "index" OR "update"
+        :return: (data_bytes, ids, spans) spans ARE WHERE EACH ACTION AND DOCUMENT IS
+        """
+        data_bytes = bytearray()
+        ids = []
+        spans = []
+        for r in records:
+            id = r.get("id")
+            r_value = r.get('value')
+            if id == None and r_value:
+                id = r_value.get('_id')
+            if id == None:
+                if action == "update":
+                    Log.error("Expecting every update to have an \"id\" property")
+                id = random_id()
+
+            if "json" in r:
+                json_bytes = r["json"]
+                if isinstance(json_bytes, unicode):
+                    json_bytes = json_bytes.encode("utf8")
+            elif r_value or isinstance(r_value, (dict, Data)):
+                json_bytes = convert.value2json(r_value).encode("utf8")
+            else:
+                json_bytes = None
+                Log.error("Expecting every record given to have \"value\" or \"json\" property")
+
+            if self.settings.tjson:
+                json_bytes = json2typed(json_bytes.decode('utf8')).encode('utf8')
+
+            start_action = len(data_bytes)
+            data_bytes += b'{"' + action.encode("ascii") + b'":{"_id":' + _id2bytes(id) + b'}}\n'
+            start = len(data_bytes)
+            if action == "update":
+                data_bytes += b'{"doc":' + json_bytes + (b',"doc_as_upsert":true}' if upsert else b'}')
+            else:
+                data_bytes += json_bytes
+            ids.append(id)
+            spans.append((start_action, start, len(data_bytes)))
+            data_bytes += b'\n'
+        return data_bytes, ids, spans
+
+    def _bulk_post(self, data_bytes, num):
+        """
+        :return: THE items OF THE BULK RESPONSE
+        """
+        with Timer("Add {{num}} documents to {{index}}", {"num": num, "index": self.settings.index}, debug=self.debug) as timer:
+            adapter = self.cluster.adapter
+            response = self.cluster.post(
+                self.path + "/_bulk",
+                data=data_bytes,
+                headers={"Content-Type": adapter.bulk_content_type},
+                timeout=self.settings.timeout,
+                retry=self.settings.retry,
+                params=adapter.write_params(self.settings.consistency)
+            )
+            items = response["items"]
+        if self.adaptive_batch:
+            self.adaptive_batch.measure(len(items), len(data_bytes), timer.duration.seconds)
+        return items
+
+    def _insert_problem(self, failed):
+        cause = [
+            Except(
+                template="{{status}} {{error}} (and {{some}} others) while loading line id={{id}} into index {{index|quote}}:\n{{line}}",
+                status=f["status"],
+                error=f["error"],
+                some=len(failed) - 1,
+                line=strings.limit(f["line"], 500 if not self.debug else 100000),
+                index=self.settings.index,
+                id=f["id"]
+            )
+            for f in (failed if len(failed) <= 3 else failed[0:1:])
+        ]
+        # THE cause IS ONLY A SAMPLE, failed HAS EVERY ITEM, SEE bulk_failures()
+        Log.error("Problems with insert", failed=failed, cause=cause)
 
     # RECORDS MUST HAVE id AND json AS A STRING OR
     # HAVE id AND value AS AN OBJECT
@@ -382,32 +504,79 @@ class Index(Features):
         else:
             interval = unicode(seconds) + "s"
 
+        self.put_settings({"refresh_interval": interval}, **kwargs)
+
+    def get_settings(self):
+        """
+        :return: FLAT index SETTINGS (eg {"index.refresh_interval": "1s"}) AS A dict
+        """
+        response = self.cluster.get("/" + self.settings.index + "/_settings?flat_settings=true")
+        for name, details in unwrap(response).items():
+            # ALIASES CAN POINT TO MANY INDEXES, THE FIRST IS GOOD ENOUGH
+            return details.get("settings", {})
+        return {}
+
+    def put_settings(self, settings, **kwargs):
+        """
+        :param settings: index SETTINGS, WITHOUT THE "index." PREFIX
+        :param kwargs: ANY OTHER REQUEST PARAMETERS
+        :return: None
+        """
         if self.cluster.version.startswith("0.90."):
             response = self.cluster.put(
                 "/" + self.settings.index + "/_settings",
-                data='{"index":{"refresh_interval":' + convert.value2json(interval) + '}}',
+                data=convert.value2json({"index": settings}),
                 **kwargs
             )
 
             result = mo_json.json2value(utf82unicode(response.all_content))
             if not result.ok:
-                Log.error("Can not set refresh interval ({{error}})", {
+                Log.error("Can not set index settings ({{error}})", {
                     "error": utf82unicode(response.all_content)
                 })
-        elif any(map(self.cluster.version.startswith, ["1.4.", "1.5.", "1.6.", "1.7."])):
+        else:
             response = self.cluster.put(
                 "/" + self.settings.index + "/_settings",
-                data=convert.unicode2utf8('{"index":{"refresh_interval":' + convert.value2json(interval) + '}}'),
+                data=convert.unicode2utf8(convert.value2json({"index": settings})),
+                headers={"Content-Type": "application/json"},
                 **kwargs
             )
 
             result = mo_json.json2value(utf82unicode(response.all_content))
             if not result.acknowledged:
-                Log.error("Can not set refresh interval ({{error}})", {
+                Log.error("Can not set index settings ({{error}})", {
                     "error": utf82unicode(response.all_content)
                 })
-        else:
-            Log.error("Do not know how to handle ES version {{version}}", version=self.cluster.version)
+
+    @contextmanager
+    def bulk_load(self, replicas=True):
+        """
+        TURN OFF REFRESH (AND REPLICAS) WHILE LOADING MANY DOCUMENTS
+        THE ORIGINAL SETTINGS ARE RESTORED, AND THE INDEX REFRESHED, ON EXIT,
+        EVEN IF THE LOAD FAILED
+        :param replicas: True TO ALSO DROP number_of_replicas TO ZERO
+        """
+        if self.settings.read_only:
+            Log.error("Index opened in read only mode, no changes allowed")
+
+        original = self.get_settings()
+        restore = {"refresh_interval": original.get("index.refresh_interval", "1s")}
+        bulk = {"refresh_interval": -1}
+        if replicas:
+            restore["number_of_replicas"] = int(original.get("index.number_of_replicas", 1))
+            bulk["number_of_replicas"] = 0
+
+        Log.note("Bulk load {{index}} with {{settings|json}}", index=self.settings.index, settings=bulk)
+        self.put_settings(bulk)
+        try:
+            yield self
+        finally:
+            try:
+                self.put_settings(restore)
+                self.refresh()
+                Log.note("Bulk load of {{index}} done, restored {{settings|json}}", index=self.settings.index, settings=restore)
+            except Exception as e:
+                Log.warning("Can not restore {{index}} settings to {{settings|json}}", index=self.settings.index, settings=restore, cause=e)
 
     def search(self, query, timeout=None, retry=None):
         query = wrap(query)
@@ -419,12 +588,14 @@ class Index(Features):
                 else:
                     show_query = query
                 Log.note("Query:\n{{query|indent}}", query=show_query)
-            return self.cluster.post(
+            adapter = self.cluster.adapter
+            result = self.cluster.post(
                 self.path + "/_search",
-                data=query,
+                data=adapter.query(query),
                 timeout=coalesce(timeout, self.settings.timeout),
                 retry=retry
             )
+            return adapter.response(query, result)
         except Exception as e:
             Log.error(
                 "Problem with search (path={{path}}):\n{{query|indent}}",
@@ -433,7 +604,92 @@ class Index(Features):
                 cause=e
             )
 
-    def threaded_queue(self, batch_size=None, max_size=None, period=None, silent=False):
+    def search_stream(self, query, timeout=None, retry=None):
+        """
+        SAME AS search(), BUT THE hits ARE PARSED ONE AT A TIME, AS THEY
+        ARRIVE, SO MEMORY DOES NOT GROW WITH THE NUMBER OF hits
+        :return: SearchStream
+        """
+        query = wrap(query)
+        try:
+            if self.debug:
+                Log.note("Query:\n{{query|indent}}", query=query)
+            adapter = self.cluster.adapter
+            output = self.cluster.post_stream(
+                self.path + "/_search",
+                data=adapter.query(query),
+                timeout=coalesce(timeout, self.settings.timeout),
+                retry=retry
+            )
+            output.hit = lambda h: adapter.hit(query, h)
+            return output
+        except Exception as e:
+            Log.error(
+                "Problem with search (path={{path}}):\n{{query|indent}}",
+                path=self.path + "/_search",
+                query=query,
+                cause=e
+            )
+
+    def scroll(self, query, scroll="5m", timeout=None, retry=None, slice=None):
+        """
+        GENERATOR OF hits PAGES, USING THE ES SCROLL CURSOR
+        EVERY PAGE COSTS THE SAME, NO MATTER HOW DEEP INTO THE RESULT SET
+
+        :param query: THE ES QUERY; size IS THE NUMBER OF HITS PER PAGE
+        :param scroll: HOW LONG ES KEEPS THE CURSOR ALIVE BETWEEN PAGES
+        :param timeout: NUMBER OF SECONDS TO WAIT FOR EACH PAGE
+        :param slice: (id, max) PAIR TO SCROLL THROUGH ONLY ONE OF max PARTS (ES 5+)
+        :return: GENERATOR OF hits.hits LISTS
+        """
+        query = wrap(query)
+        timeout = coalesce(timeout, self.settings.timeout)
+        adapter = self.cluster.adapter
+        try:
+            if self.debug:
+                Log.note("Scroll:\n{{query|indent}}", query=query)
+            result = adapter.response(query, self.cluster.post(
+                self.path + "/_search",
+                data=adapter.scroll(query, slice),
+                params={"scroll": scroll},
+                timeout=timeout,
+                retry=retry
+            ))
+        except Exception as e:
+            Log.error(
+                "Problem with scroll (path={{path}}):\n{{query|indent}}",
+                path=self.path + "/_search",
+                query=query,
+                cause=e
+            )
+
+        scroll_id = result._scroll_id
+        try:
+            while result.hits.hits:
+                yield result.hits.hits
+                params, data = adapter.scroll_next(scroll, scroll_id)
+                result = adapter.response(query, self.cluster.post(
+                    "/_search/scroll",
+                    data=data,
+                    params=params,
+                    timeout=timeout,
+                    retry=retry
+                ))
+                scroll_id = coalesce(result._scroll_id, scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    path, data = adapter.clear_scroll(scroll_id)
+                    self.cluster.delete(path, data=data)
+                except Exception as e:
+                    Log.warning("Scroll cursor not cleared, it will expire on its own", cause=e)
+
+    def threaded_queue(self, batch_size=None, max_size=None, period=None, silent=False, sink=None):
+        """
+        :param sink: THE OBJECT WHOSE extend() IS CALLED WITH EACH BATCH (DEFAULT self)
+        """
+        backoff = Data(seconds=0, last=0)
+
         def errors(e, _buffer):  # HANDLE ERRORS FROM extend()
             if e.cause.cause:
                 not_possible = [f for f in listwrap(e.cause.cause) if any(h in f for h in HOPELESS)]
@@ -444,7 +700,14 @@ class Index(Features):
 
             if still_have_hope:
                 if "429 EsRejectedExecutionException[rejected execution (queue capacity" in e:
-                    Log.note("waiting for ES to be free ({{num}} pending)", num=len(_buffer))
+                    # BACK OFF EXPONENTIALLY; THE QUEUE FILLS, AND BLOCKS THE WRITERS
+                    now = Date.now().unix
+                    if now - backoff.last > MAX_BACKOFF * 2:
+                        backoff.seconds = 0
+                    backoff.seconds = Math.min(Math.max(1, backoff.seconds * 2), MAX_BACKOFF)
+                    backoff.last = now
+                    Log.note("waiting {{seconds}} seconds for ES to be free ({{num}} pending)", seconds=backoff.seconds, num=len(_buffer))
+                    Till(seconds=backoff.seconds).wait()
                 elif "503 UnavailableShardsException" in e:
                     Log.note("waiting for ES to initialize shards ({{num}} pending)", num=len(_buffer))
                 else:
@@ -456,7 +719,7 @@ class Index(Features):
 
         return ThreadedQueue(
             "push to elasticsearch: " + self.settings.index,
-            self,
+            coalesce(sink, self),
             batch_size=batch_size,
             max_size=max_size,
             period=period,
@@ -468,6 +731,161 @@ class Index(Features):
         self.cluster.delete_index(index_name=self.settings.index)
 
 
+def _id2bytes(id):
+    if isinstance(id, basestring):
+        return quote(id).encode("utf8")
+    else:
+        return convert.value2json(id).encode("utf8")
+
+
+def bulk_failures(e):
+    """
+    :param e: EXCEPTION RAISED BY extend(), update() OR delete_ids()
+    :return: EVERY failed ITEM {"position", "id", "status", "error", "line"},
+             OR None IF e IS NOT ABOUT THE DOCUMENTS (NETWORK, CLUSTER DOWN)
+    """
+    e = Except.wrap(e)
+    while e:
+        failed = wrap(e.params).failed
+        if failed:
+            return failed
+        e = listwrap(e.cause)[0] if e.cause else None
+    return None
+
+
+def _item_status(item):
+    """
+    :return: (status, error) OF ONE BULK RESPONSE item
+    """
+    # item IS {"index": details}, OR {"delete": details}, ETC
+    item = coalesce(item.index, item.create, item.update, item.delete)
+    if item.status != None:
+        return item.status, item.error
+    # 0.90.x HAS NO status
+    if item.ok:
+        return 200, None
+    elif "EsRejectedExecutionException" in coalesce(item.error, ""):
+        return 429, item.error
+    else:
+        return 400, item.error
+
+
+def _span(data_bytes, span):
+    """
+    THE DOCUMENT AT span, AS UNICODE
+    """
+    _, start, end = span
+    return str(data_bytes[start:end]).decode("utf8")
+
+
+def _bulk_subset(data_bytes, spans, subset):
+    """
+    :return: (data_bytes, spans) FOR ONLY THE subset (LIST OF INDEXES)
+    """
+    output = bytearray()
+    new_spans = []
+    for i in subset:
+        action, start, end = spans[i]
+        offset = len(output) - action
+        output += data_bytes[action:end + 1]
+        new_spans.append((action + offset, start + offset, end + offset))
+    return output, new_spans
+
+
+class DeadLetter(object):
+    """
+    WHERE THE DOCUMENTS ES WILL NOT ACCEPT ARE KEPT, ALONG WITH THEIR ERROR
+    EITHER A LOCAL file (ONE JSON PER LINE) OR AN ES index
+    """
+
+    @override
+    def __init__(self, file=None, index=None, kwargs=None):
+        self.locker = Lock("dead letter")
+        self.file = file
+        self.index = None
+        if index:
+            self.index = Cluster(kwargs).get_or_create_index(kwargs)
+        elif not file:
+            Log.error("Expecting a dead_letter file or index")
+
+    def extend(self, index, failed):
+        now = Date.now().unix
+        # THE DOCUMENT IS KEPT AS A STRING, IT MAY BE WHY IT FAILED
+        docs = [
+            {
+                "index": index,
+                "id": f["id"],
+                "status": f["status"],
+                "error": unicode(f["error"]),
+                "document": f["line"],
+                "timestamp": now
+            }
+            for f in failed
+        ]
+        if self.index:
+            self.index.extend([{"value": d} for d in docs])
+        else:
+            with self.locker:
+                with open(self.file, b"ab") as f:
+                    for d in docs:
+                        f.write(convert.value2json(d).encode("utf8") + b"\n")
+
+
+class AdaptiveBatchSize(object):
+    """
+    LEARN HOW MANY DOCUMENTS TO SEND PER BULK REQUEST, SO EACH REQUEST
+    IS ABOUT target_bytes IN SIZE, AND TAKES NO MORE THAN target_seconds
+    """
+
+    @override
+    def __init__(
+        self,
+        name,
+        size=1000,  # STARTING NUMBER OF DOCUMENTS
+        min_size=10,
+        max_size=50000,
+        target_bytes=10 * 1000 * 1000,
+        target_seconds=10,
+        kwargs=None
+    ):
+        self.name = name
+        self.locker = Lock("adaptive batch size for " + name)
+        self.size = size
+        self.settings = kwargs
+
+    def measure(self, num_docs, num_bytes, seconds):
+        """
+        :param num_docs: NUMBER OF DOCUMENTS IN THE BULK REQUEST
+        :param num_bytes: SIZE OF THE BULK REQUEST BODY
+        :param seconds: TIME IT TOOK
+        """
+        if not num_docs or not num_bytes:
+            return
+        s = self.settings
+        by_bytes = num_docs * s.target_bytes / num_bytes
+        by_time = num_docs * s.target_seconds / Math.max(seconds, 0.001)
+        ideal = Math.min(by_bytes, by_time)
+
+        with self.locker:
+            old_size = self.size
+            # MOVE HALF WAY TO THE IDEAL, AND NO MORE THAN DOUBLE (OR HALF) AT ONCE
+            new_size = Math.min((old_size + ideal) / 2, old_size * 2)
+            new_size = Math.max(new_size, old_size / 2)
+            self.size = int(Math.min(Math.max(new_size, s.min_size), s.max_size))
+
+        if abs(self.size - old_size) > old_size / 10:
+            Log.note(
+                "Batch size for {{name}} is now {{size}} ({{bytes|comma}} bytes in {{seconds|round(places=2)}} seconds for {{num}} documents)",
+                name=self.name,
+                size=self.size,
+                bytes=num_bytes,
+                seconds=seconds,
+                num=num_docs
+            )
+
+
+MAX_BACKOFF = 60  # MOST SECONDS TO WAIT AFTER ES REJECTS A BULK REQUEST
+RETRY_STATUS = [429, 503]  # BULK ITEM STATUS WORTH SENDING AGAIN
 HOPELESS = [
     "Document contains at least one immense term",
     "400 MapperParsingException",
@@ -479,6 +897,14 @@ HOPELESS = [
 
 
 known_clusters = {}
+NODE_FAILURE_STATUS = [502, 503, 504]
+NODE_FAILURES = [
+    "NodeNotConnectedException",
+    "timed out",
+    "Connection refused",
+    "Connection aborted",
+    "Max retries exceeded"
+]
 
 class Cluster(object):
 
@@ -495,10 +921,24 @@ class Cluster(object):
         return cluster
 
     @override
-    def __init__(self, host, port=9200, explore_metadata=True, kwargs=None):
+    def __init__(
+        self,
+        host,
+        port=9200,
+        explore_metadata=True,
+        zip=None,
+        zip_level=None,
+        hosts=None,  # MORE NODES ("http://host:port") TO SEND REQUESTS TO
+        discover_nodes=False,  # ASK /_nodes/http FOR ALL THE NODES
+        balance="least",  # "least" OUTSTANDING REQUESTS, OR "round_robin"
+        node_retry=60,  # SECONDS TO AVOID A NODE AFTER IT FAILS
+        kwargs=None
+    ):
         """
         settings.explore_metadata == True - IF PROBING THE CLUSTER FOR METADATA IS ALLOWED
         settings.timeout == NUMBER OF SECONDS TO WAIT FOR RESPONSE, OR SECONDS TO WAIT FOR DOWNLOAD (PASSED TO requests)
+        settings.zip == True TO GZIP REQUEST BODIES, False TO NEVER, None TO ASK THE CLUSTER IF IT ACCEPTS THEM
+        settings.zip_level == zlib COMPRESSION LEVEL FOR REQUEST BODIES
         """
         if hasattr(self, "settings"):
             return
@@ -506,11 +946,18 @@ class Cluster(object):
         self.settings = kwargs
         self.cluster_state = None
         self._metadata = None
+        self._metadata_versions = {}  # MAP FROM INDEX PATTERNS ("" FOR ALL) TO CLUSTER STATE VERSION LOADED
         self.metadata_locker = Lock()
         self.debug = kwargs.debug
         self.version = None
+        self.adapter = VersionAdapter(None)
         self.path = kwargs.host + ":" + unicode(kwargs.port)
-        self.get_metadata()
+        self._zip = zip
+        self._zip_locker = Lock("zip probe")
+        self.nodes = Nodes([self.path] + [h.rstrip("/") for h in listwrap(hosts) if h.rstrip("/") != self.path], balance=balance, retry_after=node_retry)
+        self._get_version()
+        if discover_nodes:
+            self._discover_nodes()
 
     @override
     def get_or_create_index(
@@ -535,7 +982,7 @@ class Cluster(object):
             kwargs.index = best.index
 
         index = kwargs.index
-        meta = self.get_metadata()
+        meta = self.get_metadata(index=index)
         columns = parse_properties(index, ".", meta.indices[index].mappings.values()[0].properties)
         if len(columns)!=0:
             kwargs.tjson = tjson or any(c.names[best.index].endswith("$value") for c in columns)
@@ -657,8 +1104,7 @@ class Cluster(object):
         # CONFIRM INDEX EXISTS
         while True:
             try:
-                state = self.get("/_cluster/state", retry={"times": 5}, timeout=3)
-                if index in state.metadata.indices:
+                if self.get_metadata(force=True, index=index).indices[index]:
                     break
                 Log.note("Waiting for index {{index}} to appear", index=index)
             except Exception as e:
@@ -686,7 +1132,7 @@ class Cluster(object):
 
         url = self.settings.host + ":" + unicode(self.settings.port) + "/" + index_name
         try:
-            response = http.delete(url)
+            response = self._call(http.delete, "/" + index_name)
             if response.status_code != 200:
                 Log.error("Expecting a 200, got {{code}}", code=response.status_code)
             details = mo_json.json2value(utf82unicode(response.content))
@@ -711,39 +1157,173 @@ class Cluster(object):
                     output.append({"index": index, "alias": a})
         return wrap(output)
 
-    def get_metadata(self, force=False):
+    def _get_version(self):
+        with self.metadata_locker:
+            if self.version:
+                return
+            self.cluster_state = wrap(self.get("/"))
+            self.version = self.cluster_state.version.number
+            self.adapter = VersionAdapter(self.version)
+
+    def get_metadata(self, force=False, index=None):
+        """
+        :param force: LOOK FOR CHANGES, EVEN IF WE HAVE THE METADATA ALREADY
+        :param index: ONLY LOAD THE METADATA FOR THESE INDEXES (OR ALIASES, OR PATTERNS)
+        :return: THE CLUSTER METADATA;  indices ALSO HAS AN ENTRY FOR EACH ALIAS
+        """
         if not self.settings.explore_metadata:
             Log.error("Metadata exploration has been disabled")
 
-        if not self._metadata or force:
-            response = self.get("/_cluster/state", retry={"times": 3}, timeout=30)
-            with self.metadata_locker:
-                self._metadata = wrap(response.metadata)
-                # REPLICATE MAPPING OVER ALL ALIASES
+        patterns = ",".join(sorted(listwrap(index)))
+        with self.metadata_locker:
+            # THE FULL METADATA ("") COVERS EVERY PATTERN
+            loaded = patterns if patterns in self._metadata_versions else "" if "" in self._metadata_versions else None
+            if self._metadata and not force and loaded is not None:
+                return self._metadata
+        self._get_version()
+
+        if self.version.startswith("0.90."):
+            # NO WAY TO ASK FOR LESS
+            state = self.get("/_cluster/state", retry={"times": 3}, timeout=30)
+            patterns = ""
+        else:
+            if loaded is not None:
+                # ONLY PULL THE METADATA IF THE CLUSTER STATE CHANGED
+                version = self.get("/_cluster/state/version", retry={"times": 3}, timeout=30).version
+                if version == self._metadata_versions[loaded]:
+                    return self._metadata
+            state = self.get(
+                "/_cluster/state/version,metadata" + ("/" + patterns if patterns else ""),
+                retry={"times": 3},
+                timeout=30
+            )
+
+        with self.metadata_locker:
+            if not patterns or not self._metadata:
+                self._metadata = wrap(state.metadata)
+                self._metadata_versions = {}
+                indices = self._metadata.indices
+                names = list(indices.keys())
+            else:
                 indices = self._metadata.indices
-                for i, m in jx.sort(indices.items(), {"value": {"offset": 0}, "sort": -1}):
-                    m.index = i
-                    for a in m.aliases:
-                        if not indices[a]:
-                            indices[a] = m
-                self.cluster_state = wrap(self.get("/"))
-                self.version = self.cluster_state.version.number
+                names = list(state.metadata.indices.keys())
+                for name in names:
+                    indices[name] = state.metadata.indices[name]
+            self._metadata_versions[patterns] = state.version
+
+            # ALIASES POINT TO THE NEWEST INDEX (THE ONE WITH THE GREATEST NAME)
+            for name in names:
+                m = indices[name]
+                m.index = name
+                for a in m.aliases:
+                    existing = indices[a]
+                    if not existing or (existing.index != a and existing.index < name):
+                        indices[a] = m
             return self._metadata
 
-        return self._metadata
+    def _discover_nodes(self):
+        """
+        SEND REQUESTS TO ALL THE NODES WITH HTTP ENABLED
+        """
+        scheme = self.settings.host.split("://")[0] if "://" in self.settings.host else "http"
+        urls = []
+        for _, node in self.get("/_nodes/http").nodes.items():
+            # publish_address LOOKS LIKE "10.0.0.1:9200", OR "inet[/10.0.0.1:9200]" (1.x)
+            match = re.search(r"([\w\.\-]+):(\d+)\]?$", coalesce(node.http.publish_address, ""))
+            if match:
+                urls.append(scheme + "://" + match.group(1) + ":" + match.group(2))
+        if urls:
+            self.nodes.set(urls)
+            Log.note("{{path}} has nodes {{nodes|json}}", path=self.path, nodes=urls)
+        else:
+            Log.warning("No http nodes found for {{path}}", path=self.path)
+
+    def node_stats(self):
+        """
+        :return: LIST OF {"url", "requests", "outstanding", "failures", "healthy"}
+        """
+        return self.nodes.stats()
+
+    def _call(self, method, path, **kwargs):
+        """
+        SEND REQUEST TO THE NEXT NODE;  TRY THE OTHER NODES WHILE THEY ARE NOT RESPONDING
+        :param method: THE http FUNCTION (http.get, http.post, ...)
+        :return: THE RESPONSE
+        """
+        attempts = len(self.nodes)
+        for attempt in range(attempts):
+            node = self.nodes.acquire()
+            try:
+                response = method(node.url + path, **kwargs)
+            except Exception as e:
+                e = Except.wrap(e)
+                failed = any(f in e for f in NODE_FAILURES)
+                self.nodes.release(node, failed=failed)
+                if failed and attempt < attempts - 1:
+                    Log.warning("Node {{url}} is not responding, try another", url=node.url, cause=e)
+                    continue
+                raise e
+
+            failed = response.status_code in NODE_FAILURE_STATUS or (
+                response.status_code == 500 and b"NodeNotConnectedException" in response.content
+            )
+            self.nodes.release(node, failed=failed)
+            if failed and attempt < attempts - 1:
+                Log.warning("Node {{url}} returned {{status}}, try another", url=node.url, status=response.status_code)
+                continue
+            return response
+
+    def can_zip(self, path):
+        """
+        :param path: THE REQUEST ABOUT TO BE SENT, ITS INDEX IS USED TO PROBE THE CLUSTER
+        :return: True IF REQUEST BODIES SHOULD BE GZIPPED
+        """
+        if self._zip is not None:
+            return self._zip
+        index = path.lstrip("/").split("/")[0].split("?")[0]
+        if not index or index.startswith("_"):
+            # NO INDEX TO PROBE (CLUSTER-WIDE SEARCH WOULD HIT EVERY SHARD), DO NOT ZIP UNTIL WE KNOW
+            return False
+        with self._zip_locker:
+            if self._zip is None:
+                self._zip = self._probe_zip(index)
+                if self._zip is not None:
+                    Log.note("{{path}} accepts gzip requests: {{zip}}", path=self.path, zip=self._zip)
+        return bool(self._zip)
+
+    def _probe_zip(self, index):
+        try:
+            response = self._call(
+                http.post,
+                "/" + index + "/_search?size=0",
+                data=convert.bytes2zip(b'{"size":0}'),
+                headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+                zip=False,
+                timeout=coalesce(self.settings.timeout, 30)
+            )
+            if response.status_code == 404:
+                # NO SUCH INDEX (YET), ASK AGAIN NEXT TIME
+                return None
+            if response.status_code != 200:
+                return False
+            return not mo_json.json2value(utf82unicode(response.all_content)).error
+        except Exception:
+            return False
 
     def post(self, path, **kwargs):
         url = self.settings.host + ":" + unicode(self.settings.port) + path
 
         try:
-            wrap(kwargs).headers["Accept-Encoding"] = "gzip,deflate"
+            _json_headers(kwargs)
+            kwargs.setdefault(b"zip", self.can_zip(path))
+            kwargs.setdefault(b"zip_level", self.settings.zip_level)
 
             data = kwargs.get(b'data')
             if data == None:
                 pass
             elif isinstance(data, Mapping):
                 kwargs[b'data'] = data =convert.unicode2utf8(convert.value2json(data))
-            elif not isinstance(kwargs["data"], str):
+            elif not isinstance(kwargs["data"], (str, bytearray)):
                 Log.error("data must be utf8 encoded string")
 
             if self.debug:
@@ -752,7 +1332,7 @@ class Cluster(object):
 
             if self.debug:
                 Log.note("POST {{url}}", url=url)
-            response = http.post(url, **kwargs)
+            response = self._call(http.post, path, **kwargs)
             if response.status_code not in [200, 201]:
                 Log.error(response.reason.decode("latin1") + ": " + strings.limit(response.content.decode("latin1"), 100 if self.debug else 10000))
             if self.debug:
@@ -775,16 +1355,47 @@ class Cluster(object):
                 Log.error(
                     "Problem with call to {{url}}" + suggestion + "\n{{body|left(10000)}}",
                     url=url,
-                    body=strings.limit(kwargs["data"], 100 if self.debug else 10000),
+                    body=strings.limit(str(kwargs["data"]) if isinstance(kwargs["data"], bytearray) else kwargs["data"], 100 if self.debug else 10000),
                     cause=e
                 )
             else:
                 Log.error("Problem with call to {{url}}" + suggestion, url=url, cause=e)
 
+    def post_stream(self, path, **kwargs):
+        """
+        SAME AS post(), BUT FOR SEARCHES:  THE RESPONSE IS NOT READ HERE, THE
+        RETURNED SearchStream PARSES THE hits AS THEY ARE ITERATED
+        """
+        url = self.settings.host + ":" + unicode(self.settings.port) + path
+
+        try:
+            _json_headers(kwargs)
+            kwargs.setdefault(b"zip", self.can_zip(path))
+            kwargs.setdefault(b"zip_level", self.settings.zip_level)
+
+            data = kwargs.get(b'data')
+            if data == None:
+                pass
+            elif isinstance(data, Mapping):
+                kwargs[b'data'] = convert.unicode2utf8(convert.value2json(data))
+            elif not isinstance(kwargs["data"], str):
+                Log.error("data must be utf8 encoded string")
+
+            if self.debug:
+                Log.note("POST {{url}}", url=url)
+            response = self._call(http.post, path, **kwargs)
+            if response.status_code not in [200, 201]:
+                Log.error(response.reason.decode("latin1") + ": " + strings.limit(response.content.decode("latin1"), 100 if self.debug else 10000))
+            return SearchStream(response)
+        except Exception as e:
+            Log.error("Problem with call to {{url}}", url=url, cause=e)
+
     def delete(self, path, **kwargs):
         url = self.settings.host + ":" + unicode(self.settings.port) + path
         try:
-            response = http.delete(url, **kwargs)
+            if kwargs.get(b"data") != None:
+                _json_headers(kwargs)
+            response = self._call(http.delete, path, **kwargs)
             if response.status_code not in [200]:
                 Log.error(response.reason+": "+response.all_content)
             if self.debug:
@@ -801,7 +1412,7 @@ class Cluster(object):
         try:
             if self.debug:
                 Log.note("GET {{url}}", url=url)
-            response = http.get(url, **kwargs)
+            response = self._call(http.get, path, **kwargs)
             if response.status_code not in [200]:
                 Log.error(response.reason + ": " + response.all_content)
             if self.debug:
@@ -816,7 +1427,7 @@ class Cluster(object):
     def head(self, path, **kwargs):
         url = self.settings.host + ":" + unicode(self.settings.port) + path
         try:
-            response = http.head(url, **kwargs)
+            response = self._call(http.head, path, **kwargs)
             if response.status_code not in [200]:
                 Log.error(response.reason+": "+response.all_content)
             if self.debug:
@@ -838,7 +1449,9 @@ class Cluster(object):
             sample = kwargs["data"][:300]
             Log.note("PUT {{url}}:\n{{data|indent}}", url=url, data=sample)
         try:
-            response = http.put(url, **kwargs)
+            if kwargs.get(b"data") != None:
+                _json_headers(kwargs)
+            response = self._call(http.put, path, **kwargs)
             if response.status_code not in [200]:
                 Log.error(response.reason+": "+response.all_content)
             if self.debug:
@@ -848,6 +1461,307 @@ class Cluster(object):
             Log.error("Problem with call to {{url}}",  url= url, cause=e)
 
 
+def _json_headers(kwargs):
+    """
+    ES 6+ REJECTS BODIES WITHOUT A Content-Type
+    """
+    headers = wrap(kwargs).headers
+    headers["Accept-Encoding"] = "gzip,deflate"
+    if not any(k.lower() == "content-type" for k in headers.keys()):
+        headers["Content-Type"] = "application/json"
+
+
+class Nodes(object):
+    """
+    SPREAD REQUESTS OVER THE NODES OF A CLUSTER, AND AVOID THE NODES THAT ARE FAILING
+    """
+
+    def __init__(self, urls, balance="least", retry_after=60):
+        self.locker = Lock("nodes")
+        self.balance = balance
+        self.retry_after = retry_after
+        self.next = 0
+        self.nodes = []
+        self.set(urls)
+
+    def set(self, urls):
+        with self.locker:
+            existing = {n.url: n for n in self.nodes}
+            self.nodes = [existing.get(u) or _Node(u) for u in urls]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def acquire(self):
+        """
+        :return: THE NODE TO SEND THE NEXT REQUEST TO;  release() IT WHEN DONE
+        """
+        now = time()
+        with self.locker:
+            healthy = [n for n in self.nodes if n.down_until <= now]
+            if not healthy:
+                # ALL ARE FAILING, TRY THE ONE THAT FAILED LONGEST AGO
+                healthy = [min(self.nodes, key=lambda n: n.down_until)]
+            self.next += 1
+            if self.balance == "round_robin":
+                node = healthy[self.next % len(healthy)]
+            else:
+                least = min(n.outstanding for n in healthy)
+                candidates = [n for n in healthy if n.outstanding == least]
+                node = candidates[self.next % len(candidates)]
+            node.outstanding += 1
+            node.requests += 1
+            return node
+
+    def release(self, node, failed=False):
+        with self.locker:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                node.down_until = time() + self.retry_after
+            else:
+                node.down_until = 0
+
+    def stats(self):
+        now = time()
+        with self.locker:
+            return wrap([
+                {
+                    "url": n.url,
+                    "requests": n.requests,
+                    "outstanding": n.outstanding,
+                    "failures": n.failures,
+                    "healthy": n.down_until <= now
+                }
+                for n in self.nodes
+            ])
+
+
+class _Node(object):
+    __slots__ = ["url", "outstanding", "requests", "failures", "down_until"]
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.down_until = 0
+
+
+class SearchStream(object):
+    """
+    THE hits.hits OF A SEARCH RESPONSE, PARSED ONE AT A TIME, STRAIGHT FROM
+    THE SOCKET.  header HAS THE REST (took, _shards, total) ONCE THE FIRST
+    HIT HAS BEEN SEEN
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.header = Data()
+        self.hit = lambda h: h  # VERSION ADAPTER FOR EACH HIT
+
+    def __iter__(self):
+        response = self.response
+
+        def read():
+            return response.raw.read(http.MIN_READ_SIZE, decode_content=True)
+
+        try:
+            # ES PUTS THE HEADER PROPERTIES BEFORE hits.hits, SO THEY ARE SEEN WITH EVERY HIT
+            for row in stream.parse(read, "hits.hits", ["took", "_shards", "hits.total", "hits.hits"]):
+                row = wrap(row)
+                if not self.header:
+                    total = row.hits.total
+                    self.header = wrap({"took": row.took, "_shards": row._shards, "total": coalesce(total.value, total)})
+                    if row._shards.failed > 0:
+                        Log.error("Shard failures {{failures|indent}}",
+                            failures="---\n".join(r.replace(";", ";\n") for r in row._shards.failures.reason)
+                        )
+                yield self.hit(row.hits.hits)
+        finally:
+            response.close()
+
+
+class VersionAdapter(object):
+    """
+    THIS LIBRARY SPEAKS THE ES 1.x QUERY LANGUAGE;  TRANSLATE THE QUERIES,
+    AND RESPONSES, FOR THE version OF THE CLUSTER WE ARE TALKING TO
+    """
+
+    def __init__(self, version):
+        self.version = version
+        try:
+            self.major = int(version.split(".")[0])
+        except Exception:
+            self.major = 1  # UNKNOWN, ASSUME 1.x
+        # ES 6+ DEMANDS THE PROPER CONTENT TYPE
+        self.bulk_content_type = "application/x-ndjson" if self.major >= 5 else "text"
+
+    def write_params(self, consistency):
+        if self.major >= 5:
+            # consistency WAS REPLACED BY wait_for_active_shards
+            return {}
+        return {"consistency": consistency}
+
+    def query(self, query):
+        """
+        :param query: ES 1.x QUERY
+        :return: QUERY FOR THIS CLUSTER
+        """
+        if self.major < 2:
+            return query
+
+        query = wrap(query).copy()
+        query.query = _bool_filters(query.query)
+        if query.filter:
+            # THE TOP-LEVEL filter IS NOW post_filter
+            query.post_filter = _bool_filters(query.filter)
+            query.filter = None
+        if query.facets:
+            query.aggs = set_default({
+                name: _facet2agg(name, f)
+                for name, f in query.facets.items()
+            }, query.aggs)
+            query.facets = None
+        if self.major >= 5 and query.fields:
+            fields = [f for f in listwrap(query.fields) if f != "_id"]
+            if "_source" in fields:
+                query._source = True
+            else:
+                query._source = fields
+            query.fields = None
+        if self.major >= 7:
+            # OTHERWISE hits.total STOPS COUNTING AT 10000
+            query.track_total_hits = True
+        return query
+
+    def scroll(self, query, slice):
+        output = self.query(query)
+        if not output.sort and self.major >= 2:
+            # NO ORDER REQUESTED, SO USE THE NATURAL ORDER, WHICH IS FASTEST
+            output = wrap(output).copy()
+            output.sort = ["_doc"]
+        if slice:
+            if self.major < 5:
+                Log.error("Sliced scroll needs ES 5 or better, not {{version}}", version=self.version)
+            output = wrap(output).copy()
+            output.slice = {"id": slice[0], "max": slice[1]}
+        return output
+
+    def scroll_next(self, scroll, scroll_id):
+        """
+        :return: (params, data) TO REQUEST THE NEXT SCROLL PAGE
+        """
+        if self.major < 2:
+            return {"scroll": scroll}, convert.unicode2utf8(scroll_id)
+        return None, convert.unicode2utf8(convert.value2json({"scroll": scroll, "scroll_id": scroll_id}))
+
+    def clear_scroll(self, scroll_id):
+        """
+        :return: (path, data) TO DELETE THE SCROLL CURSOR
+        """
+        if self.major < 2:
+            return "/_search/scroll/" + scroll_id, None
+        return "/_search/scroll", convert.unicode2utf8(convert.value2json({"scroll_id": [scroll_id]}))
+
+    def response(self, query, result):
+        """
+        :param query: THE ORIGINAL (ES 1.x) QUERY
+        :param result: RESPONSE FROM THIS CLUSTER
+        :return: THE RESPONSE, AS ES 1.x WOULD HAVE SENT IT
+        """
+        if self.major < 2:
+            return result
+
+        total = result.hits.total
+        if isinstance(total, Mapping):
+            # ES 7+
+            result.hits.total = total.value
+        if query.facets:
+            result.facets = {
+                name: _agg2facet(f, result.aggregations[name])
+                for name, f in query.facets.items()
+            }
+        if self.major >= 5 and query.fields:
+            for h in result.hits.hits:
+                self.hit(query, h)
+        return result
+
+    def hit(self, query, hit):
+        """
+        ES 5+ ONLY HAS fields THAT ARE STORED, SO PULL THEM FROM _source
+        """
+        if self.major >= 5 and query.fields and not hit.fields:
+            fields = [f for f in listwrap(query.fields) if f not in ["_id", "_source"]]
+            # KEYED BY THE FULL NAME, LIKE ES 1.x DOES, SO hit.fields[literal_field(f)] FINDS IT
+            hit.fields = {f: hit._source[f] for f in fields}
+        return hit
+
+
+def _bool_filters(filter):
+    """
+    REPLACE THE filtered, and, or, not AND missing FILTERS (GONE AFTER ES 2)
+    WITH THEIR bool EQUIVALENT
+    """
+    if isinstance(filter, list):
+        return [_bool_filters(f) for f in filter]
+    if not isinstance(filter, Mapping):
+        return filter
+
+    output = {}
+    for k, v in filter.items():
+        if k == "filtered":
+            must = _bool_filters(v.query)
+            bool_ = {"filter": _bool_filters(v.filter)}
+            if must and set(must.keys()) != {"match_all"}:
+                bool_["must"] = must
+            output["bool"] = bool_
+        elif k == "and":
+            output["bool"] = {"filter": _bool_filters(_filter_list(v))}
+        elif k == "or":
+            output["bool"] = {"should": _bool_filters(_filter_list(v)), "minimum_should_match": 1}
+        elif k == "not":
+            output["bool"] = {"must_not": _bool_filters(coalesce(v.filter, v))}
+        elif k == "missing":
+            output["bool"] = {"must_not": {"exists": {"field": v.field}}}
+        else:
+            output[k] = _bool_filters(v)
+    return wrap(output)
+
+
+def _filter_list(filter):
+    # {"and": [...]} OR {"and": {"filters": [...]}}
+    if isinstance(filter, Mapping):
+        return listwrap(filter.filters)
+    return listwrap(filter)
+
+
+def _facet2agg(name, facet):
+    if facet.terms:
+        agg = {"terms": {"field": facet.terms.field, "size": coalesce(facet.terms.size, 10)}}
+    elif facet.statistical:
+        agg = {"stats": {"field": facet.statistical.field}}
+    elif facet.filter:
+        agg = {"filter": _bool_filters(facet.filter)}
+    else:
+        Log.error("Do not know how to convert facet {{name}} to an aggregation", name=name)
+
+    if facet.facet_filter:
+        return {"filter": _bool_filters(facet.facet_filter), "aggs": {"_filter": agg}}
+    return agg
+
+
+def _agg2facet(facet, agg):
+    if facet.facet_filter:
+        agg = agg._filter
+    if facet.terms:
+        return {"_type": "terms", "terms": [{"term": b.key, "count": b.doc_count} for b in agg.buckets]}
+    elif facet.statistical:
+        return {"_type": "statistical", "count": agg.count, "min": agg.min, "max": agg.max, "mean": agg.avg, "total": agg.sum}
+    else:
+        return {"_type": "filter", "count": agg.doc_count}
+
+
 def proto_name(prefix, timestamp=None):
     if not timestamp:
         timestamp = Date.now()
@@ -934,7 +1848,6 @@ class Alias(Features):
             if not explore_metadata:
                 Log.error("Alias() was given no `type` (aka schema) and not allowed to explore metadata.  Do not know what to do now.")
 
-            indices = self.cluster.get_metadata().indices
             if not self.settings.alias or self.settings.alias==self.settings.index:
                 alias_list = self.cluster.get("/_alias/"+self.settings.index)
                 candidates = [(name, i) for name, i in alias_list.items() if self.settings.index in i.aliases.keys()]
@@ -965,7 +1878,7 @@ class Alias(Features):
 
     def get_schema(self, retry=True):
         if self.settings.explore_metadata:
-            indices = self.cluster.get_metadata().indices
+            indices = self.cluster.get_metadata(force=not retry, index=self.settings.index).indices
             if not self.settings.alias or self.settings.alias==self.settings.index:
                 #PARTIALLY DEFINED settings
                 candidates = [(name, i) for name, i in indices.items() if self.settings.index in i.aliases]
@@ -984,7 +1897,6 @@ class Alias(Features):
 
             if index == None and retry:
                 #TRY AGAIN, JUST IN CASE
-                self.cluster.cluster_state = None
                 return self.get_schema(retry=False)
 
             #TODO: REMOVE THIS BUG CORRECTION
@@ -1006,8 +1918,6 @@ class Alias(Features):
             return wrap({"mappings": mapping[self.settings.type]})
 
     def delete(self, filter):
-        self.cluster.get_metadata()
-
         if self.cluster.cluster_state.version.number.startswith("0.90"):
             query = {"filtered": {
                 "query": {"match_all": {}},
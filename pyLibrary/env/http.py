@@ -20,19 +20,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+from cookielib import DefaultCookiePolicy
 from copy import copy
 from mmap import mmap
 from numbers import Number
 from tempfile import TemporaryFile
+from time import time
+from urlparse import urlparse
 
 from requests import sessions, Response
+from requests.adapters import HTTPAdapter
 
 import mo_json
 from pyLibrary import convert
 from mo_logs.exceptions import Except
 from mo_logs import Log
 from mo_dots import Data, coalesce, wrap, set_default, unwrap
-from pyLibrary.env.big_data import safe_size, ibytes2ilines, icompressed2ibytes
+from pyLibrary.env.big_data import safe_size, ibytes2ilines, icompressed2ibytes, ibytes2icompressed
 from mo_math import Math
 from pyLibrary.queries import jx
 from mo_threads import Thread, Lock
@@ -43,13 +47,20 @@ DEBUG = False
 FILE_SIZE_LIMIT = 100 * 1024 * 1024
 MIN_READ_SIZE = 8 * 1024
 ZIP_REQUEST = False
+ZIP_LEVEL = 6  # 1 (FAST) TO 9 (SMALL)
+ZIP_MIN_SIZE = 1000  # SMALLER REQUEST BODIES ARE NOT WORTH COMPRESSING
 default_headers = Data()  # TODO: MAKE THIS VARIABLE A SPECIAL TYPE OF EXPECTED MODULE PARAMETER SO IT COMPLAINS IF NOT SET
 default_timeout = 600
+POOL_SIZE = 10  # CONNECTIONS KEPT OPEN TO EACH HOST (0 FOR A NEW SESSION PER REQUEST)
+KEEP_ALIVE = 60  # SECONDS A HOST'S CONNECTIONS ARE KEPT AFTER ITS LAST REQUEST IS DONE (0 FOR UNTIL THE SERVER CLOSES THEM)
 
 _warning_sent = False
+_pools = {}  # MAP FROM (scheme, host, port) TO _Pool
+_pools_locker = Lock("http pools")
+_zip_stats = {}  # MAP FROM host TO _ZipStats
 
 
-def request(method, url, zip=None, retry=None, **kwargs):
+def request(method, url, zip=None, zip_level=None, retry=None, **kwargs):
     """
     JUST LIKE requests.request() BUT WITH DEFAULT HEADERS AND FIXES
     DEMANDS data IS ONE OF:
@@ -59,6 +70,7 @@ def request(method, url, zip=None, retry=None, **kwargs):
 
     Parameters
      * zip - ZIP THE REQUEST BODY, IF BIG ENOUGH
+     * zip_level - zlib COMPRESSION LEVEL (DEFAULT ZIP_LEVEL)
      * json - JSON-SERIALIZABLE STRUCTURE
      * retry - {"times": x, "sleep": y} STRUCTURE
 
@@ -81,7 +93,7 @@ def request(method, url, zip=None, retry=None, **kwargs):
         failures = []
         for remaining, u in jx.countdown(url):
             try:
-                response = request(method, u, zip=zip, retry=retry, **kwargs)
+                response = request(method, u, zip=zip, zip_level=zip_level, retry=retry, **kwargs)
                 if Math.round(response.status_code, decimal=-2) not in [400, 500]:
                     return response
                 if not remaining:
@@ -91,9 +103,13 @@ def request(method, url, zip=None, retry=None, **kwargs):
                 failures.append(e)
         Log.error("Tried {{num}} urls", num=len(url), cause=failures)
 
+    pool = None
     if b"session" in kwargs:
         session = kwargs[b"session"]
         del kwargs[b"session"]
+    elif POOL_SIZE:
+        pool = _checkout(url)
+        session = pool.session
     else:
         session = sessions.Session()
     session.headers.update(default_headers)
@@ -126,28 +142,36 @@ def request(method, url, zip=None, retry=None, **kwargs):
         headers = kwargs[b"headers"] = unwrap(coalesce(wrap(kwargs)[b"headers"], {}))
         set_default(headers, {b"accept-encoding": b"compress, gzip"})
 
-        if zip and len(coalesce(kwargs.get(b"data"))) > 1000:
-            compressed = convert.bytes2zip(kwargs[b"data"])
+        raw = None
+        data = kwargs.get(b"data")
+        if zip and isinstance(data, (str, bytearray)) and len(data) > ZIP_MIN_SIZE:
+            # COMPRESSED AS IT IS SENT, SEE BELOW
+            raw = data
             headers[b'content-encoding'] = b'gzip'
-            kwargs[b"data"] = compressed
+            stats = _get_zip_stats(url)
 
-            _to_ascii_dict(headers)
-        else:
-            _to_ascii_dict(headers)
+        _to_ascii_dict(headers)
     except Exception as e:
         Log.error("Request setup failure on {{url}}", url=url, cause=e)
 
     errors = []
-    for r in range(retry.times):
-        if r:
-            Till(seconds=retry.sleep).wait()
+    try:
+        for r in range(retry.times):
+            if r:
+                Till(seconds=retry.sleep).wait()
 
-        try:
-            if DEBUG:
-                Log.note("http {{method}} to {{url}}", method=method, url=url)
-            return session.request(method=method, url=url, **kwargs)
-        except Exception as e:
-            errors.append(Except.wrap(e))
+            try:
+                if DEBUG:
+                    Log.note("http {{method}} to {{url}}", method=method, url=url)
+                if raw is not None:
+                    # A NEW GENERATOR FOR EACH ATTEMPT
+                    kwargs[b"data"] = ibytes2icompressed(raw, level=coalesce(zip_level, ZIP_LEVEL), stats=stats)
+                return session.request(method=method, url=url, **kwargs)
+            except Exception as e:
+                errors.append(Except.wrap(e))
+    finally:
+        if pool:
+            _checkin(pool)
 
     if " Read timed out." in errors[0]:
         Log.error("Tried {{times}} times: Timeout failure (timeout was {{timeout}}", timeout=timeout, times=retry.times, cause=errors[0])
@@ -155,6 +179,158 @@ def request(method, url, zip=None, retry=None, **kwargs):
         Log.error("Tried {{times}} times: Request failure of {{url}}", url=url, times=retry.times, cause=errors[0])
 
 
+class _Pool(object):
+    """
+    ONE SESSION, AND ITS CONNECTIONS, SHARED BY ALL THREADS (AND ALL CALLERS)
+    TALKING TO A HOST.  SINCE EVERY CALLER SEES THE SAME SESSION, IT KEEPS NO
+    COOKIES; PASS YOUR OWN session TO request() IF YOU NEED THEM
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.requests = 0
+        self.active = 0  # REQUESTS NOT DONE YET
+        self.last_done = time()  # WHEN THE LAST REQUEST WAS DONE
+        self.closed_connections = 0
+        self.closed_requests = 0
+        self.session = sessions.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        # requests SESSIONS ARE SAFE TO SHARE, urllib3 HANDS EACH THREAD ITS OWN CONNECTION,
+        # AND CHECKS IT WAS NOT DROPPED (BY AN IDLE SERVER) BEFORE REUSE
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def connection_stats(self):
+        """
+        :return: (connections, requests) MADE BY urllib3
+        """
+        connections, requests = self.closed_connections, self.closed_requests
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for k in pools.keys():
+                p = pools.get(k)
+                if p is not None:
+                    connections += p.num_connections
+                    requests += p.num_requests
+        return connections, requests
+
+    def drop_idle(self):
+        """
+        CLOSE THE CONNECTIONS NOT IN USE;  A CONNECTION STILL STREAMING A
+        RESPONSE IS CLOSED BY urllib3 WHEN THE RESPONSE IS DONE
+        """
+        self.closed_connections, self.closed_requests = self.connection_stats()
+        for adapter in set(self.session.adapters.values()):
+            adapter.poolmanager.clear()
+
+
+def get_session(url):
+    """
+    :return: THE POOLED SESSION FOR THE (scheme, host, port) OF url
+    """
+    pool = _checkout(url)
+    _checkin(pool)
+    return pool.session
+
+
+def _checkout(url):
+    """
+    :return: THE _Pool FOR THE (scheme, host, port) OF url, COUNTED AS BUSY UNTIL _checkin()
+    """
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.hostname, parsed.port)
+    with _pools_locker:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = _Pool(parsed.scheme + "://" + parsed.netloc)
+        elif KEEP_ALIVE and not pool.active and time() - pool.last_done > KEEP_ALIVE:
+            # THE SERVER HAS PROBABLY CLOSED THE IDLE CONNECTIONS ANYWAY
+            pool.drop_idle()
+        pool.requests += 1
+        pool.active += 1
+        return pool
+
+
+def _checkin(pool):
+    with _pools_locker:
+        pool.active -= 1
+        pool.last_done = time()
+
+
+def pool_stats():
+    """
+    :return: LIST OF {"host", "requests", "connections", "reused"}, ONE FOR EACH HOST
+    """
+    with _pools_locker:
+        pools = list(_pools.values())
+
+    output = []
+    for p in pools:
+        connections, requests = p.connection_stats()
+        output.append({
+            "host": p.host,
+            "requests": p.requests,
+            "connections": connections,
+            "reused": requests - connections
+        })
+    return wrap(output)
+
+
+class _ZipStats(object):
+    """
+    TOTAL REQUEST COMPRESSION DONE FOR A HOST
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.locker = Lock("zip stats for " + host)
+        self.requests = 0
+        self.raw = 0
+        self.compressed = 0
+        self.seconds = 0
+
+    def add(self, raw, compressed, seconds):
+        with self.locker:
+            self.requests += 1
+            self.raw += raw
+            self.compressed += compressed
+            self.seconds += seconds
+
+
+def _get_zip_stats(url):
+    parsed = urlparse(url)
+    host = parsed.scheme + "://" + parsed.netloc
+    with _pools_locker:
+        stats = _zip_stats.get(host)
+        if stats is None:
+            stats = _zip_stats[host] = _ZipStats(host)
+        return stats
+
+
+def zip_stats():
+    """
+    :return: LIST OF {"host", "requests", "raw", "compressed", "ratio", "seconds", "bytes_per_second"}, ONE FOR EACH HOST
+    ratio IS compressed/raw;  seconds IS TIME SPENT COMPRESSING;  bytes_per_second IS THE RAW BYTES COMPRESSED PER SECOND
+    """
+    with _pools_locker:
+        stats = list(_zip_stats.values())
+
+    output = []
+    for s in stats:
+        with s.locker:
+            output.append({
+                "host": s.host,
+                "requests": s.requests,
+                "raw": s.raw,
+                "compressed": s.compressed,
+                "ratio": s.compressed / s.raw if s.raw else None,
+                "seconds": s.seconds,
+                "bytes_per_second": s.raw / s.seconds if s.seconds else None
+            })
+    return wrap(output)
+
+
 def _to_ascii_dict(headers):
     if headers is None:
         return
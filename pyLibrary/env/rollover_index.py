@@ -8,15 +8,21 @@
 #
 from __future__ import unicode_literals
 
+import json
+import re
+import types
+from bisect import bisect_left
+from time import time
+
 import mo_json
 from activedata_etl import etl2path
 from activedata_etl import key2etl
 from mo_dots import coalesce, wrap, Null
 from mo_kwargs import override
 from mo_logs import Log, strings
-from mo_logs.exceptions import suppress_exception
+from mo_logs.exceptions import suppress_exception, Except
 from mo_math.randoms import Random
-from mo_threads import Lock
+from mo_threads import Lock, Queue, Thread, THREAD_STOP, Till, Signal
 from mo_times.dates import Date, unicode2Date, unix2Date
 from mo_times.durations import Duration
 from mo_times.timer import Timer
@@ -26,6 +32,7 @@ from pyLibrary.env import elasticsearch
 from pyLibrary.queries import jx
 
 MAX_RECORD_LENGTH = 400000
+MAINTENANCE_INTERVAL = 10 * 60  # SECONDS BETWEEN LOOKING FOR OLD INDEXES TO DELETE
 
 
 class RolloverIndex(object):
@@ -34,13 +41,29 @@ class RolloverIndex(object):
     AND THREADED QUEUE AND SPLIT DATA BY
     """
     @override
-    def __init__(self, rollover_field, rollover_interval, rollover_max, queue_size=10000, batch_size=5000, kwargs=None):
+    def __init__(
+        self,
+        rollover_field,
+        rollover_interval,
+        rollover_max,
+        queue_size=10000,
+        queue_bytes=100 * 1024 * 1024,
+        batch_size=5000,
+        flush_period=1,
+        flush_threads=2,
+        idle_timeout=5 * 60,
+        kwargs=None
+    ):
         """
         :param rollover_field: the FIELD with a timestamp to use for determining which index to push to
         :param rollover_interval: duration between roll-over to new index
         :param rollover_max: remove old indexes, do not add old records
-        :param queue_size: number of documents to queue in memory
+        :param queue_size: number of documents to queue in memory, over all rollover periods
+        :param queue_bytes: number of (json) bytes to queue in memory, over all rollover periods
         :param batch_size: number of documents to push at once
+        :param flush_period: most seconds a document waits in memory
+        :param flush_threads: number of threads sending documents to ES
+        :param idle_timeout: seconds before a rollover period that is not used is closed
         :param kwargs: plus additional ES settings
         :return:
         """
@@ -51,6 +74,42 @@ class RolloverIndex(object):
         self.rollover_max = self.settings.rollover_max = Duration(kwargs.rollover_max)
         self.known_queues = {}  # MAP DATE TO INDEX
         self.cluster = elasticsearch.Cluster(self.settings)
+        self.candidates = None  # THE ROLLOVER INDEXES, SORTED BY date
+        self.candidate_dates = None  # date OF EACH CANDIDATE, FOR bisect
+        self.budget_locker = Lock("memory budget for rollover_index")
+        self.resident_docs = 0  # DOCUMENTS WAITING IN ALL THE QUEUES
+        self.resident_bytes = 0
+        self.to_flush = Queue("rollover queues to flush", unique=True, silent=True)  # THE _PeriodQueues READY TO SEND
+        self.please_stop = Signal("stop rollover for " + self.settings.index)
+        self.threads = None  # STARTED ON FIRST WRITE
+
+    def _start(self):
+        """
+        START THE BACKGROUND THREADS, IF NOT ALREADY
+        """
+        with self.locker:
+            if self.threads is not None or self.please_stop:
+                return
+            self.threads = (
+                [
+                    Thread.run("rollover maintenance for " + self.settings.index, self._maintenance, please_stop=self.please_stop),
+                    Thread.run("rollover flusher for " + self.settings.index, self._flusher, please_stop=self.please_stop)
+                ] +
+                [
+                    Thread.run("rollover sender " + unicode(i) + " for " + self.settings.index, self._sender)
+                    for i in range(self.settings.flush_threads)
+                ]
+            )
+
+    def close(self):
+        """
+        SEND WHAT IS LEFT IN MEMORY, AND STOP THE BACKGROUND THREADS
+        """
+        self.please_stop.go()
+        with self.locker:
+            threads, self.threads = self.threads, []
+        for t in threads or []:
+            t.join()
 
     def __getattr__(self, item):
         return getattr(self.cluster, item)
@@ -68,25 +127,19 @@ class RolloverIndex(object):
         with self.locker:
             queue = self.known_queues.get(rounded_timestamp.unix)
         if queue == None:
-            candidates = jx.run({
-                "from": self.cluster.get_aliases(),
-                "where": {"regex": {"index": self.settings.index + "\d\d\d\d\d\d\d\d_\d\d\d\d\d\d"}},
-                "sort": "index"
-            })
-            best = None
-            for c in candidates:
-                c = wrap(c)
-                c.date = unicode2Date(c.index[-15:], elasticsearch.INDEX_DATE_FORMAT)
-                if timestamp > c.date:
-                    best = c
+            candidates, dates = self._get_candidates()
+            # THE LAST INDEX STARTING BEFORE timestamp
+            best = candidates[bisect_left(dates, timestamp) - 1] if dates and dates[0] < timestamp else None
             if not best or rounded_timestamp > best.date:
-                if rounded_timestamp < wrap(candidates[-1]).date:
+                if candidates and rounded_timestamp < candidates[-1].date:
                     es = elasticsearch.Index(read_only=False, alias=best.alias, index=best.index, kwargs=self.settings)
                 else:
                     try:
                         es = self.cluster.create_index(create_timestamp=rounded_timestamp, kwargs=self.settings)
                         es.add_alias(self.settings.index)
+                        self._reset_candidates()
                     except Exception as e:
+                        self._reset_candidates()
                         if "IndexAlreadyExistsException" not in e:
                             Log.error("Problem creating index", cause=e)
                         return self._get_queue(row)  # TRY AGAIN
@@ -96,27 +149,155 @@ class RolloverIndex(object):
             with suppress_exception:
                 es.set_refresh_interval(seconds=60 * 5, timeout=5)
 
-            self._delete_old_indexes(candidates)
-            threaded_queue = es.threaded_queue(max_size=self.settings.queue_size, batch_size=self.settings.batch_size, silent=True)
             with self.locker:
-                queue = self.known_queues[rounded_timestamp.unix] = threaded_queue
+                # ANOTHER copy() THREAD MAY HAVE MADE THE QUEUE FIRST
+                queue = self.known_queues.get(rounded_timestamp.unix)
+                if queue == None:
+                    queue = self.known_queues[rounded_timestamp.unix] = _PeriodQueue(self, es, rounded_timestamp)
+            self._start()
         return queue
 
-    def _delete_old_indexes(self, candidates):
+    def _spent(self, docs, bytes):
+        with self.budget_locker:
+            self.resident_docs += docs
+            self.resident_bytes += bytes
+
+    def _make_room(self):
+        """
+        BLOCK THE WRITER UNTIL WE ARE BACK UNDER BUDGET;  THE BIGGEST QUEUES ARE SENT FIRST
+        """
+        while self.resident_docs > self.settings.queue_size or self.resident_bytes > self.settings.queue_bytes:
+            with self.locker:
+                queues = [q for q in self.known_queues.values() if q.buffer]
+            if not queues:
+                return
+            self.to_flush.add(max(queues, key=lambda q: (q.bytes, -coalesce(q.oldest, 0))))
+            with self.budget_locker:
+                self.budget_locker.wait(till=Till(seconds=1))
+
+    def _sender(self, please_stop):
+        """
+        SEND THE QUEUES THAT ARE READY
+        """
+        for q in self.to_flush:
+            try:
+                q.flush()
+            except Exception as e:
+                Log.warning("Problem flushing {{index}}", index=q.index.settings.index, cause=e)
+
+    def _flusher(self, please_stop):
+        """
+        SEND THE DOCUMENTS THAT WAITED flush_period, AND CLOSE THE QUEUES NOT USED FOR idle_timeout
+        """
+        while not please_stop:
+            (please_stop | Till(seconds=self.settings.flush_period)).wait()
+            now = time()
+            with self.locker:
+                queues = list(self.known_queues.items())
+            for t, q in queues:
+                if (q.buffer or q.callbacks) and (q.oldest == None or q.oldest + self.settings.flush_period <= now):
+                    self.to_flush.add(q)
+                elif not q.buffer and not q.callbacks and q.last_used + self.settings.idle_timeout < now:
+                    with self.locker:
+                        if self.known_queues.get(t) is q:
+                            del self.known_queues[t]
+                    q.close()
+
+        # SEND WHAT IS LEFT
+        with self.locker:
+            queues = list(self.known_queues.values())
+        for q in queues:
+            q.closed = True
+            try:
+                q.flush()
+            except Exception as e:
+                Log.warning("Problem flushing {{index}}", index=q.index.settings.index, cause=e)
+        for _ in range(self.settings.flush_threads):
+            self.to_flush.add(THREAD_STOP)
+
+    def queue_stats(self):
+        """
+        :return: LIST OF {"index", "period", "docs", "bytes"}, ONE FOR EACH ROLLOVER PERIOD IN MEMORY
+        """
+        with self.locker:
+            queues = list(self.known_queues.values())
+        return wrap([
+            {
+                "index": q.index.settings.index,
+                "period": q.period,
+                "docs": len(q.buffer),
+                "bytes": q.bytes
+            }
+            for q in sorted(queues, key=lambda q: q.period)
+        ])
+
+    def _get_candidates(self):
+        """
+        :return: (candidates, dates) THE ROLLOVER INDEXES, AND THEIR DATES, SORTED BY DATE
+        """
+        with self.locker:
+            if self.candidates is not None:
+                return self.candidates, self.candidate_dates
+
+        pattern = re.compile(re.escape(self.settings.index) + r"\d{8}_\d{6}$")
+        candidates = []
+        for a in self.cluster.get_aliases():
+            if pattern.match(a.index):
+                candidates.append(wrap({
+                    "index": a.index,
+                    "alias": a.alias,
+                    "date": unicode2Date(a.index[-15:], elasticsearch.INDEX_DATE_FORMAT)
+                }))
+        candidates.sort(key=lambda c: c.date)
+        dates = [c.date for c in candidates]
+
+        with self.locker:
+            self.candidates, self.candidate_dates = candidates, dates
+        return candidates, dates
+
+    def _reset_candidates(self):
+        """
+        CALL WHEN AN INDEX IS CREATED OR DELETED
+        """
+        with self.locker:
+            self.candidates = None
+            self.candidate_dates = None
+
+    def _maintenance(self, please_stop):
+        while not please_stop:
+            try:
+                self._delete_old_indexes()
+            except Exception as e:
+                Log.warning("Problem deleting old indexes", cause=e)
+            if self.resident_docs:
+                Log.note(
+                    "{{docs}} documents ({{bytes|comma}} bytes) in memory: {{stats|json}}",
+                    docs=self.resident_docs,
+                    bytes=self.resident_bytes,
+                    stats=self.queue_stats()
+                )
+            (please_stop | Till(seconds=MAINTENANCE_INTERVAL)).wait()
+
+    def _delete_old_indexes(self):
+        candidates, _ = self._get_candidates()
+        oldest = Date.today() - self.rollover_max
         for c in candidates:
-            timestamp = unicode2Date(c.index[-15:], "%Y%m%d_%H%M%S")
-            if timestamp + self.rollover_interval < Date.today() - self.rollover_max:
+            if c.date + self.rollover_interval < oldest:
                 # Log.warning("Will delete {{index}}", index=c.index)
                 try:
                     self.cluster.delete_index(c.index)
                 except Exception as e:
                     Log.warning("could not delete index {{index}}", index=c.index, cause=e)
-        for t, q in list(self.known_queues.items()):
-            if unix2Date(t) + self.rollover_interval < Date.today() - self.rollover_max:
-                with self.locker:
+                finally:
+                    self._reset_candidates()
+        expired = []
+        with self.locker:
+            for t in list(self.known_queues.keys()):
+                if unix2Date(t) + self.rollover_interval < oldest:
+                    expired.append(self.known_queues[t])
                     del self.known_queues[t]
-
-        pass
+        for q in expired:
+            q.close()
 
     # ADD keys() SO ETL LOOP CAN FIND WHAT'S GETTING REPLACED
     def keys(self, prefix=None):
@@ -162,57 +343,231 @@ class RolloverIndex(object):
     def delete(self, filter):
         self.es.delete(filter)
 
-    def copy(self, keys, source, sample_only_filter=None, sample_size=None, done_copy=None):
+    def copy(self, keys, source, sample_only_filter=None, sample_size=None, done_copy=None, threads=1):
         """
         :param keys: THE KEYS TO LOAD FROM source
         :param source: THE SOURCE (USUALLY S3 BUCKET)
         :param sample_only_filter: SOME FILTER, IN CASE YOU DO NOT WANT TO SEND EVERYTHING
         :param sample_size: FOR RANDOM SAMPLE OF THE source DATA
         :param done_copy: CALLBACK, ADDED TO queue, TO FINISH THE TRANSACTION
+        :param threads: NUMBER OF keys TO READ (AND DECOMPRESS, AND fix) AT THE SAME TIME
         :return: LIST OF SUB-keys PUSHED INTO ES
         """
+        keys = list(keys)
+        todo = Queue("keys to copy", max=len(keys) + threads)
+        todo.extend(keys)
+        for _ in range(threads):
+            todo.add(THREAD_STOP)
+
+        locker = Lock("copy")
+        totals = wrap({"num_keys": 0, "failed": False})
+        queues = set()  # THE QUEUES THAT WERE SENT SOMETHING
+
+        def reader(please_stop):
+            for key in todo:
+                timer = Timer("Process {{key}}", param={"key": key})
+                try:
+                    with timer:
+                        num, queue = self._copy_key(key, source, sample_only_filter, sample_size)
+                    with locker:
+                        totals.num_keys += num
+                        if queue != None:
+                            queues.add(queue)
+                    Log.note(
+                        "{{num}} records from {{key}} in {{duration|round(places=2)}} seconds ({{rate|round(places=0)}} records/second)",
+                        num=num,
+                        key=key,
+                        duration=timer.duration.seconds,
+                        rate=num / timer.duration.seconds if timer.duration.seconds else None
+                    )
+                except Exception as e:
+                    with locker:
+                        totals.failed = True
+                    Log.warning("Could not process {{key}} after {{duration|round(places=2)}}seconds", key=key, duration=timer.duration.seconds, cause=e)
+
+        readers = [Thread.run("copy keys " + unicode(i), reader) for i in range(threads)]
+        for r in readers:
+            r.join()
+
+        if done_copy and not totals.failed:
+            if not queues:
+                done_copy()
+            else:
+                # FINISH THE TRANSACTION ONLY AFTER EVERY QUEUE HAS SENT ITS PART
+                remaining = [len(queues)]
+
+                def done_all():
+                    with locker:
+                        remaining[0] -= 1
+                        if remaining[0]:
+                            return
+                    done_copy()
+
+                for q in queues:
+                    q.add(done_all)
+
+        Log.note("{{num}} keys from {{key|json}} added", num=totals.num_keys, key=keys)
+        return totals.num_keys
+
+    def _copy_key(self, key, source, sample_only_filter, sample_size):
+        """
+        :return: (NUMBER OF RECORDS, THE QUEUE THEY WERE SENT TO)
+        """
         num_keys = 0
         queue = None
         pending = []  # FOR WHEN WE DO NOT HAVE QUEUE YET
-        for key in keys:
-            timer = Timer("Process {{key}}", param={"key": key})
-            try:
-                with timer:
-                    for rownum, line in enumerate(source.read_lines(strip_extension(key))):
-                        if not line:
-                            continue
-
-                        if rownum > 0 and rownum % 1000 == 0:
-                            Log.note("Ingested {{num}} records from {{key}} in bucket {{bucket}}", num=rownum, key=key, bucket=source.name)
-
-                        row, please_stop = fix(rownum, line, source, sample_only_filter, sample_size)
-                        num_keys += 1
-
-                        if queue == None:
-                            queue = self._get_queue(row)
-                            if queue == None:
-                                pending.append(row)
-                                continue
-                            if pending:
-                                queue.extend(pending)
-                                pending = []
-
-                        queue.add(row)
-
-                        if please_stop:
-                            break
-            except Exception as e:
-                done_copy = None
-                Log.warning("Could not process {{key}} after {{duration|round(places=2)}}seconds", key=key, duration=timer.duration.seconds, cause=e)
+        for rownum, line in enumerate(source.read_lines(strip_extension(key))):
+            if not line:
+                continue
+
+            if rownum > 0 and rownum % 1000 == 0:
+                Log.note("Ingested {{num}} records from {{key}} in bucket {{bucket}}", num=rownum, key=key, bucket=source.name)
+
+            row, please_stop = fix(rownum, line, source, sample_only_filter, sample_size)
+            num_keys += 1
 
-        if done_copy:
             if queue == None:
-                done_copy()
-            else:
-                queue.add(done_copy)
+                queue = self._get_queue(row)
+                if queue == None:
+                    pending.append(row)
+                    continue
+                if pending:
+                    queue.extend(pending)
+                    pending = []
+
+            queue.add(row)
+
+            if please_stop:
+                break
+        return num_keys, queue
 
-        Log.note("{{num}} keys from {{key|json}} added", num=num_keys, key=keys)
-        return num_keys
+
+class _PeriodQueue(object):
+    """
+    THE DOCUMENTS WAITING TO GO TO THE INDEX OF ONE ROLLOVER PERIOD
+    HAS THE add()/extend() OF ThreadedQueue, BUT IS FLUSHED BY THE RolloverIndex,
+    SO ALL PERIODS SHARE ONE MEMORY BUDGET
+    """
+
+    def __init__(self, owner, index, period):
+        self.owner = owner
+        self.index = index
+        self.period = period
+        self.locker = Lock("queue for " + index.settings.index)
+        self.flush_locker = Lock("flush " + index.settings.index)  # ONE FLUSH AT A TIME, SO callbacks RUN IN ORDER
+        self.buffer = []
+        self.sizes = []  # BYTES OF EACH DOCUMENT IN buffer
+        self.callbacks = []  # FUNCTIONS TO CALL AFTER THE DOCUMENTS ADDED BEFORE THEM ARE SENT
+        self.bytes = 0
+        self.oldest = None  # WHEN THE FIRST DOCUMENT IN buffer WAS ADDED
+        self.last_used = time()
+        self.closed = False
+
+    def add(self, doc):
+        if isinstance(doc, types.FunctionType):
+            with self.locker:
+                self.callbacks.append(doc)
+                self.last_used = time()
+            if self.closed:
+                self.owner.to_flush.add(self)
+            return self
+        return self.extend([doc])
+
+    def extend(self, docs):
+        docs = [_serialize(d) for d in docs]
+        sizes = [len(d["json"]) for d in docs]
+        size = sum(sizes)
+        with self.locker:
+            now = self.last_used = time()
+            if not self.buffer:
+                self.oldest = now
+            self.buffer.extend(docs)
+            self.sizes.extend(sizes)
+            self.bytes += size
+            full = len(self.buffer) >= self.owner.settings.batch_size
+        self.owner._spent(len(docs), size)
+
+        if full or self.closed:
+            self.owner.to_flush.add(self)
+        self.owner._make_room()
+        return self
+
+    def flush(self):
+        """
+        SEND EVERYTHING IN THE buffer;  CALLED BY THE RolloverIndex SENDERS
+        DOCUMENTS ES WILL NEVER ACCEPT ARE DROPPED (OR GO TO THE dead_letter),
+        THE REST ARE KEPT FOR NEXT TIME
+        :return: False IF IT COULD NOT BE SENT
+        """
+        with self.flush_locker:
+            with self.locker:
+                docs, self.buffer = self.buffer, []
+                sizes, self.sizes = self.sizes, []
+                callbacks, self.callbacks = self.callbacks, []
+                self.bytes = 0
+                self.oldest = None
+
+            batch_size = self.owner.settings.batch_size
+            for i in range(0, len(docs), batch_size):
+                batch = docs[i:i + batch_size]
+                try:
+                    self.index.extend(batch)
+                except Exception as e:
+                    e = Except.wrap(e)
+                    failed = elasticsearch.bulk_failures(e)
+                    if failed == None:
+                        # NOT ABOUT THE DOCUMENTS (NETWORK, CLUSTER DOWN), SO SEND THEM ALL AGAIN
+                        retry = range(len(batch))
+                    else:
+                        hopeless = [f for f in failed if _hopeless(f)]
+                        if hopeless:
+                            # THE GOOD DOCUMENTS ARE IN, THERE IS NOTHING WE CAN DO ABOUT THESE
+                            Log.warning("{{num}} documents not inserted into {{index}}, will not try again", num=len(hopeless), index=self.index.settings.index, cause=e)
+                        retry = sorted(f.position for f in failed if not _hopeless(f))
+
+                    if retry:
+                        Log.warning("Problem sending {{num}} documents to {{index}}, will try again", num=len(retry) + len(docs) - i - len(batch), index=self.index.settings.index, cause=e)
+                        again = [batch[p] for p in retry] + docs[i + batch_size:]
+                        again_sizes = [sizes[i + p] for p in retry] + sizes[i + batch_size:]
+                        with self.locker:
+                            self.buffer[0:0] = again
+                            self.sizes[0:0] = again_sizes
+                            self.callbacks[0:0] = callbacks
+                            self.bytes += sum(again_sizes)
+                            self.oldest = time()
+                        self.owner._spent(-(len(docs) - i - len(again)), -(sum(sizes[i:]) - sum(again_sizes)))
+                        Till(seconds=1).wait()
+                        return False
+                self.owner._spent(-len(batch), -sum(sizes[i:i + batch_size]))
+
+            for c in callbacks:
+                c()
+            return True
+
+    def close(self):
+        self.closed = True
+        self.owner.to_flush.add(self)
+
+
+def _hopeless(failure):
+    """
+    :param failure: ONE OF THE elasticsearch.bulk_failures()
+    :return: True IF ES WILL NEVER ACCEPT THE DOCUMENT
+    """
+    error = failure.error if isinstance(failure.error, basestring) else convert.value2json(failure.error)
+    if any(h in error for h in elasticsearch.HOPELESS):
+        return True
+    return 400 <= coalesce(failure.status, 0) < 500 and failure.status != 429
+
+
+def _serialize(doc):
+    """
+    :return: doc AS {"id", "json"}, SO ITS SIZE IS KNOWN, AND IT IS NOT ENCODED AGAIN LATER
+    """
+    if doc.get("json") != None:
+        return doc
+    value = doc.get("value")
+    return {"id": coalesce(doc.get("id"), wrap(value)._id), "json": convert.value2json(value)}
 
 
 def fix(rownum, line, source, sample_only_filter, sample_size):
@@ -241,15 +596,17 @@ def fix(rownum, line, source, sample_only_filter, sample_size):
             if value.etl.id != 0:
                 Log.error("Expecting etl.id==0")
             return row, True
-    elif len(line) > MAX_RECORD_LENGTH:
-        value = mo_json.json2value(line)
-        _shorten(value, source)
-        _id, value = _fix(value)
-        row = {"id": _id, "value": value}
-    elif line.find('"resource_usage":') != -1:
-        value = mo_json.json2value(line)
-        _id, value = _fix(value)
-        row = {"id": _id, "value": value}
+    elif len(line) > MAX_RECORD_LENGTH or line.find('"resource_usage":') != -1:
+        try:
+            _id, line = _fix_line(line, source)
+            row = {"id": _id, "json": line}
+        except Exception as e:
+            Log.warning("Can not fix line with the standard json library", cause=e)
+            value = mo_json.json2value(line)
+            if len(line) > MAX_RECORD_LENGTH:
+                _shorten(value, source)
+            _id, value = _fix(value)
+            row = {"id": _id, "value": value}
     else:
         # FAST
         _id = strings.between(line, "\"_id\": \"", "\"")  # AVOID DECODING JSON
@@ -287,3 +644,142 @@ def _fix(value):
     _id = value._id
 
     return _id, value
+
+
+_MEMBERS = re.compile(r'"(_id|build|repo|resource_usage|result)"\s*:\s*')
+_json_decoder = json.JSONDecoder()
+
+
+def _fix_line(line, source):
+    """
+    SAME AS _fix() (AND _shorten(), IF TOO LONG), BUT ONLY THE MEMBERS THAT
+    NEED FIXING ARE DECODED, AND RE-ENCODED, THE REST OF THE LINE IS COPIED
+    :return: (_id, line)
+    """
+    # ONE SCAN FOR THE MEMBER NAMES;  A NAME THAT APPEARS ONCE IS ASSUMED TO BE TOP-LEVEL
+    members = {}  # MAP FROM NAME TO (start OF NAME, start OF VALUE)
+    for m in _MEMBERS.finditer(line):
+        name = m.group(1)
+        if name in members:
+            # NOT SURE WHICH IS THE TOP-LEVEL ONE
+            return _fix_decoded_line(line, source)
+        members[name] = m.start(), m.end()
+
+    too_long = len(line) > MAX_RECORD_LENGTH
+    shorten = too_long and source.name.startswith("active-data-test-result")
+    if shorten and "result" not in members:
+        return _fix_decoded_line(line, source)
+
+    edits = []  # (start, end, replacement) OF THE PIECES OF line TO REPLACE
+
+    def value(name):
+        start = members[name][1]
+        v, end = _json_decoder.raw_decode(line, start)
+        return v, start, end
+
+    _id = value("_id")[0] if "_id" in members else None
+
+    result_json = None
+    if shorten:
+        result, start, end = value("result")
+        if not isinstance(result, dict):
+            return _fix_decoded_line(line, source)
+        result["subtests"] = [s for s in result.get("subtests") or [] if isinstance(s, dict) and s.get("ok") is False]
+        result["missing_subtests"] = True
+        result_json = json.dumps(result, separators=(",", ":"))
+        edits.append((start, end, result_json))
+
+    if "repo" in members:
+        repo, start, end = value("repo")
+        changed = False
+        if shorten and isinstance(repo, dict) and isinstance(repo.get("changeset"), dict) and "files" in repo["changeset"]:
+            del repo["changeset"]["files"]
+            changed = True
+        if isinstance(repo, dict) and repo.get("_source"):
+            repo = repo["_source"]
+            changed = True
+        if changed:
+            edits.append((start, end, json.dumps(repo, separators=(",", ":"))))
+
+    if "build" in members:
+        build, start, end = value("build")
+        if isinstance(build, dict) and not build.get("revision12") and isinstance(build.get("revision"), basestring):
+            build["revision12"] = build["revision"][0:12]
+            edits.append((start, end, json.dumps(build, separators=(",", ":"))))
+
+    if "resource_usage" in members:
+        # DROP THE WHOLE MEMBER, AND ONE OF THE COMMAS AROUND IT
+        start = members["resource_usage"][0]
+        end = value("resource_usage")[2]
+        after = _skip_ws(line, end)
+        if line[after:after + 1] == ",":
+            end = _skip_ws(line, after + 1)
+        else:
+            before = start
+            while line[before - 1:before] in (" ", "\t", "\r", "\n"):
+                before -= 1
+            if line[before - 1:before] == ",":
+                start = before - 1
+        edits.append((start, end, ""))
+
+    if edits:
+        pieces = []
+        last = 0
+        for start, end, replacement in sorted(edits):
+            pieces.append(line[last:start])
+            pieces.append(replacement)
+            last = end
+        pieces.append(line[last:])
+        line = "".join(pieces)
+
+    if too_long and len(line) > MAX_RECORD_LENGTH:
+        if source.name == "active-data-test-result":
+            if len(coalesce(result_json, "")) > MAX_RECORD_LENGTH:
+                Log.warning("Epic test failure in {{name}} results in big record for {{id}} of length {{length}}", id=_id, name=source.name, length=len(line))
+        else:
+            Log.warning("Monstrous {{name}} record {{id}} of length {{length}}", id=_id, name=source.name, length=len(line))
+
+    return _id, line
+
+
+def _skip_ws(line, i):
+    while line[i:i + 1] in (" ", "\t", "\r", "\n"):
+        i += 1
+    return i
+
+
+def _fix_decoded_line(line, source):
+    """
+    SAME AS _fix_line(), BUT DECODES THE WHOLE LINE, FOR WHEN THE MEMBERS CAN NOT BE FOUND WITH A SIMPLE SCAN
+    :return: (_id, line)
+    """
+    value = json.loads(line)
+    too_long = len(line) > MAX_RECORD_LENGTH
+
+    if too_long and source.name.startswith("active-data-test-result"):
+        result = value.setdefault("result", {})
+        result["subtests"] = [s for s in result.get("subtests") or [] if isinstance(s, dict) and s.get("ok") is False]
+        result["missing_subtests"] = True
+        changeset = (value.get("repo") or {}).get("changeset")
+        if isinstance(changeset, dict):
+            changeset.pop("files", None)
+
+    repo = value.get("repo")
+    if isinstance(repo, dict) and repo.get("_source"):
+        value["repo"] = repo["_source"]
+    build = value.get("build")
+    if isinstance(build, dict) and not build.get("revision12") and isinstance(build.get("revision"), basestring):
+        build["revision12"] = build["revision"][0:12]
+    value.pop("resource_usage", None)
+
+    _id = value.get("_id")
+    line = json.dumps(value, separators=(",", ":"))
+
+    if too_long and len(line) > MAX_RECORD_LENGTH:
+        if source.name == "active-data-test-result":
+            if len(json.dumps(value.get("result"))) > MAX_RECORD_LENGTH:
+                Log.warning("Epic test failure in {{name}} results in big record for {{id}} of length {{length}}", id=_id, name=source.name, length=len(line))
+        else:
+            Log.warning("Monstrous {{name}} record {{id}} of length {{length}}", id=_id, name=source.name, length=len(line))
+
+    return _id, line
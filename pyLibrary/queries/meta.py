@@ -130,7 +130,7 @@ class FromESMetadata(Schema):
         # TODO: HANDLE MORE THEN ONE ES, MAP TABLE SHORT_NAME TO ES INSTANCE
         meta = self.es_metadata.indices[table]
         if not meta or self.last_es_metadata < Date.now() - OLD_METADATA:
-            self.es_metadata = self.default_es.get_metadata(force=True)
+            self.es_metadata = self.default_es.get_metadata(force=True, index=table)
             meta = self.es_metadata.indices[table]
         self._parse_properties(meta.index, Data(properties={"_id": {"type": "string", "index": "not_analyzed"}}), meta)
         for _, properties in meta.mappings.items():
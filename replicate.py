@@ -12,17 +12,25 @@ from __future__ import division
 from __future__ import unicode_literals
 
 
+import ast
+import json
+import os
+import signal
+from contextlib import contextmanager
 from datetime import timedelta, datetime
+from time import time as _time
 
-from mo_dots import wrap, unwraplist, literal_field
+from mo_dots import wrap, unwrap, unwraplist, literal_field, coalesce, listwrap, Null, Data
 from mo_files import File
 from mo_logs import startup, constants, Log
-from mo_math import Math, MAX
-from mo_threads import Queue, Thread, Signal, THREAD_STOP
+from mo_logs.exceptions import Except
+from mo_math import Math, MAX, MIN
+from mo_threads import Queue, Thread, Signal, THREAD_STOP, Lock, Till
 from mo_times import Date
 from mo_times.timer import Timer
 
 from mo_hg.hg_mozilla_org import HgMozillaOrg
+from pyLibrary import convert
 from pyLibrary.env import elasticsearch, http
 from pyLibrary.queries import jx
 
@@ -36,10 +44,50 @@ from pyLibrary.queries import jx
 
 far_back = datetime.utcnow() - timedelta(weeks=52)
 BATCH_SIZE = 1000
-http.ZIP_REQUEST = False
+DIFF_LEAF_SIZE = 10000  # COMPARE RANGES WITH FEWER RECORDS THAN THIS DOCUMENT-BY-DOCUMENT
+BULK_LOAD_THRESHOLD = 1000000  # BACKLOGS BIGGER THAN THIS ARE LOADED WITH REFRESH TURNED OFF
 hg = None
 config = None
 
+# THE NAMES A fix EXPRESSION CAN USE;  EVERY OTHER NAME (EVEN id OR type) IS A _source PROPERTY
+FIX_NAMESPACE = {
+    "None": None,
+    "True": True,
+    "False": False,
+    "abs": abs,
+    "all": all,
+    "any": any,
+    "basestring": basestring,
+    "bool": bool,
+    "dict": dict,
+    "float": float,
+    "int": int,
+    "isinstance": isinstance,
+    "len": len,
+    "list": list,
+    "long": long,
+    "max": max,
+    "min": min,
+    "round": round,
+    "set": set,
+    "sorted": sorted,
+    "str": str,
+    "sum": sum,
+    "tuple": tuple,
+    "unicode": unicode,
+    "Date": Date,
+    "Math": Math,
+    "Null": Null,
+    "coalesce": coalesce,
+    "convert": convert,
+    "datetime": datetime,
+    "listwrap": listwrap,
+    "timedelta": timedelta,
+    "unwrap": unwrap,
+    "unwraplist": unwraplist,
+    "wrap": wrap
+}
+
 
 def get_last_updated(es):
     try:
@@ -64,68 +112,354 @@ def get_last_updated(es):
         return None
 
 
-def get_pending(source, since, pending_bugs, please_stop):
+def get_range(es):
+    """
+    RETURN (min, max) OF primary_field IN es, OR (None, None) IF EMPTY
+    """
+    results_max = es.search({
+        "query": {"match_all": {}},
+        "from": 0,
+        "size": 1,
+        "sort": {config.primary_field: "desc"}
+    })
+
+    results_min = es.search({
+        "query": {"match_all": {}},
+        "from": 0,
+        "size": 1,
+        "sort": {config.primary_field: "asc"}
+    })
+
+    if results_max.hits.total == 0:
+        return None, None
+
+    _min = results_min.hits.hits[0]._source[config.primary_field]
+    _max = results_max.hits.hits[0]._source[config.primary_field]
+    return _min, _max
+
+
+def get_slices(source, since, num_slices):
+    """
+    SPLIT THE primary_field RANGE OF source INTO num_slices DISJOINT RANGES
+    THE LAST RANGE IS OPEN-ENDED, SO IT INCLUDES RECORDS ADDED WHILE WE WORK
+    :return: LIST OF (min, max) PAIRS
+    """
+    if num_slices <= 1:
+        return [(since, None)]
+
+    _min, _max = get_range(source)
+    if _min == None:
+        return [(since, None)]
+    if since != None:
+        _min = MAX([since, _min])
+
+    if not Math.is_number(_min) or not Math.is_number(_max):
+        Log.warning("Can not slice {{field}}, it is not numeric", field=config.primary_field)
+        return [(since, None)]
+    if _min >= _max:
+        return [(since, None)]
+
+    is_integer = Math.is_integer(_min) and Math.is_integer(_max)
+    boundaries = [_min]
+    for i in range(1, num_slices):
+        b = _min + (_max - _min) * i / num_slices
+        if is_integer:
+            b = int(b)
+        if b > boundaries[-1]:
+            boundaries.append(b)
+    boundaries.append(None)
+
+    output = zip(boundaries[:-1], boundaries[1:])
+    output[0] = (since, output[0][1])
+    return output
+
+
+def get_backlog(source, slices):
+    """
+    :return: NUMBER OF source RECORDS IN THE GIVEN slices
+    """
+    result = source.search({
+        "query": {"filtered": {
+            "query": {"match_all": {}},
+            "filter": {"or": [_range_filter(since, until) for since, until in slices]}
+        }},
+        "size": 0
+    })
+    return result.hits.total
+
+
+@contextmanager
+def bulk_load_mode(source, destination, slices):
+    """
+    PUT destination IN BULK LOAD MODE (NO REFRESH, OPTIONALLY NO REPLICAS)
+    WHEN THE BACKLOG IS LARGER THAN config.bulk_load.threshold
+    """
+    threshold = coalesce(config.bulk_load.threshold, BULK_LOAD_THRESHOLD)
+    if threshold > 0:
+        backlog = get_backlog(source, slices)
+        if backlog >= threshold:
+            Log.note("Backlog of {{num}} records is over {{threshold}}, use bulk load mode", num=backlog, threshold=threshold)
+            with destination.bulk_load(replicas=coalesce(config.bulk_load.replicas, False)):
+                yield
+            return
+    yield
+
+
+def _range_filter(since, until):
+    """
+    ES FILTER FOR since <= primary_field < until
+    """
+    if since == None and until == None:
+        return {"exists": {"field": config.primary_field}}
+
+    range_ = {}
+    if since != None:
+        range_["gte"] = since
+    if until != None:
+        range_["lt"] = until
+    return {"range": {config.primary_field: range_}}
+
+
+class Throttle(object):
+    """
+    LIMIT THE NUMBER OF CONCURRENT REQUESTS MADE TO A CLUSTER
+    """
+
+    def __init__(self, name, max):
+        self.locker = Lock("throttle for " + name)
+        self.max = max
+        self.active = 0
+
+    def __enter__(self):
+        with self.locker:
+            while self.active >= self.max:
+                self.locker.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.locker:
+            self.active -= 1
+
+
+class Throttled(object):
+    """
+    MIMIC elasticsearch.Index, BUT WAIT FOR throttle BEFORE EVERY REQUEST
+    """
+
+    def __init__(self, index, throttle):
+        self.index = index
+        self.throttle = throttle
+
+    def __getattr__(self, item):
+        return getattr(self.index, item)
+
+    def search(self, query, timeout=None):
+        with self.throttle:
+            return self.index.search(query, timeout=timeout)
+
+    def scroll(self, query, scroll="5m", timeout=None):
+        pages = self.index.scroll(query, scroll=scroll, timeout=timeout)
+        try:
+            while True:
+                with self.throttle:
+                    page = next(pages, None)
+                if page is None:
+                    return
+                yield page
+        finally:
+            pages.close()
+
+    def search_stream(self, query, timeout=None):
+        with self.throttle:
+            for hit in self.index.search_stream(query, timeout=timeout):
+                yield hit
+
+    def extend(self, records):
+        adaptive_batch = self.index.adaptive_batch
+        if not adaptive_batch:
+            with self.throttle:
+                return self.index.extend(records)
+
+        # A WRITER MAY HAND US MANY BATCHES AT ONCE, SO SEND THEM IN THE SIZE
+        # LEARNED SO FAR, WHICH IS READ AGAIN BEFORE EACH BULK REQUEST
+        output = Data(ok=0, retried=0, failed=[])
+        records = list(records)
+        i = 0
+        while i < len(records):
+            size = adaptive_batch.size
+            with self.throttle:
+                result = self.index.extend(records[i:i + size])
+            output.ok += result.ok
+            output.retried += result.retried
+            for f in result.failed:
+                f.position += i
+                output.failed.append(f)
+            i += size
+        return output
+
+    def update(self, records, upsert=False):
+        with self.throttle:
+            return self.index.update(records, upsert=upsert)
+
+    def delete_ids(self, ids):
+        with self.throttle:
+            return self.index.delete_ids(ids)
+
+    def threaded_queue(self, batch_size=None, max_size=None, period=None, silent=False):
+        return self.index.threaded_queue(batch_size=batch_size, max_size=max_size, period=period, silent=silent, sink=self)
+
+
+def _pending_fields():
+    """
+    THE FIELDS THE PENDING SCAN ASKS FOR
+    """
+    if config.single_pass:
+        return ["_id", "_source", config.primary_field]
+    else:
+        return ["_id", config.primary_field]
+
+
+def _pending_values(hits):
+    """
+    WHAT THE PENDING SCAN SENDS TO replicate(): THE WHOLE HITS IN
+    single_pass MODE, OTHERWISE JUST THE _id (TO BE FETCHED LATER)
+    """
+    if config.single_pass:
+        return hits
+    else:
+        return hits._id
+
+
+def _after(value):
+    """
+    THE SMALLEST primary_field VALUE WE CARE ABOUT THAT IS GREATER THAN value
+    """
+    if Math.is_integer(value):
+        return int(value) + 1
+    elif Math.is_number(value):
+        return float(value) + 0.5
+    else:
+        return unicode(value) + "a"
+
+
+def _max_value(hits):
+    return MAX([unwraplist(h.fields[literal_field(config.primary_field)]) for h in hits])
+
+
+def _progress(pending_bugs, checkpoint, slice_index, value):
+    """
+    TELL checkpoint, ONCE THE ids ALREADY IN pending_bugs ARE REPLICATED,
+    THAT EVERYTHING IN THE SLICE BELOW value IS DONE
+    """
+    if checkpoint and value != None:
+        pending_bugs.add(Progress(checkpoint, slice_index, value))
+
+
+def get_pending(source, since, pending_bugs, please_stop, until=None, checkpoint=None, slice_index=0):
     try:
         while not please_stop:
+            start = since
             if since == None:
                 Log.note("Get all records")
-                result = source.search({
-                    # "query": {"match_all": {}},
-                    "query": {
-                        "filtered": {
-                            "filter": {"exists": {"field": config.primary_field}},
-                            "query": {"match_all": {}}
-                        }},
-                    "fields": ["_id", config.primary_field],
-                    "from": 0,
-                    "size": BATCH_SIZE,
-                    "sort": [config.primary_field]
-                })
             else:
                 Log.note(
                     "Get records with {{primary_field}} >= {{max_time|datetime}}",
                     primary_field=config.primary_field,
                     max_time=since
                 )
-                result = source.search({
-                    "query": {"filtered": {
-                        "query": {"match_all": {}},
-                        "filter": {"range": {config.primary_field: {"gte": since}}},
-                    }},
-                    "fields": ["_id", config.primary_field],
-                    "from": 0,
-                    "size": BATCH_SIZE,
-                    "sort": [config.primary_field]
-                })
+            result = source.search({
+                "query": {"filtered": {
+                    "query": {"match_all": {}},
+                    "filter": _range_filter(since, until)
+                }},
+                "fields": _pending_fields(),
+                "from": 0,
+                "size": BATCH_SIZE,
+                "sort": [config.primary_field]
+            })
 
-            new_max_value = MAX([unwraplist(h.fields[literal_field(config.primary_field)]) for h in result.hits.hits])
+            new_max_value = _max_value(result.hits.hits)
 
             if since == new_max_value:
-                # GET ALL WITH THIS TIMESTAMP
-                result = source.search({
-                    "query": {"filtered": {
-                        "query": {"match_all": {}},
-                        "filter": {"term": {config.primary_field: since}},
-                    }},
-                    "fields": ["_id", config.primary_field],
-                    "from": 0,
-                    "size": 100000
-                })
-                if Math.is_integer(new_max_value):
-                    since = int(new_max_value) + 1
-                elif Math.is_number(new_max_value):
-                    since = float(new_max_value) + 0.5
-                else:
-                    since = unicode(new_max_value) + "a"
+                # GET ALL WITH THIS TIMESTAMP, THERE CAN BE MORE THAN ONE SEARCH RETURNS
+                result = wrap({"hits": {"hits": [
+                    h
+                    for hits in source.scroll({
+                        "query": {"filtered": {
+                            "query": {"match_all": {}},
+                            "filter": {"term": {config.primary_field: since}},
+                        }},
+                        "fields": _pending_fields(),
+                        "size": BATCH_SIZE
+                    })
+                    for h in hits
+                ]}})
+                since = _after(new_max_value)
             else:
                 since = new_max_value
 
-            ids = result.hits.hits._id
+            ids = _pending_values(result.hits.hits)
             Log.note("Adding {{num}} to pending queue", num=len(ids))
             pending_bugs.extend(ids)
 
             if len(result.hits.hits) < BATCH_SIZE:
+                # EVERYTHING IN THE SLICE IS PENDING
+                if until != None:
+                    _progress(pending_bugs, checkpoint, slice_index, until)
+                elif new_max_value != None:
+                    _progress(pending_bugs, checkpoint, slice_index, _after(new_max_value))
+                else:
+                    _progress(pending_bugs, checkpoint, slice_index, start)
                 break
+            _progress(pending_bugs, checkpoint, slice_index, since)
+
+        Log.note("No more ids")
+    except Exception, e:
+        please_stop.go()
+        Log.error("Problem while copying records", cause=e)
+
+
+def get_pending_by_scroll(source, since, pending_bugs, please_stop, until=None, checkpoint=None, slice_index=0):
+    """
+    SAME AS get_pending(), BUT USES A SCROLL CURSOR, SO EVERY PAGE HAS THE
+    SAME COST, AND ANY NUMBER OF RECORDS CAN SHARE THE SAME primary_field
+    """
+    try:
+        if since == None:
+            Log.note("Get all records")
+        else:
+            Log.note(
+                "Get records with {{primary_field}} >= {{max_time|datetime}}",
+                primary_field=config.primary_field,
+                max_time=since
+            )
+
+        max_value = None
+        for hits in source.scroll({
+            "query": {"filtered": {
+                "query": {"match_all": {}},
+                "filter": _range_filter(since, until)
+            }},
+            "fields": _pending_fields(),
+            "size": BATCH_SIZE,
+            "sort": [config.primary_field]
+        }):
+            ids = _pending_values(hits)
+            Log.note("Adding {{num}} to pending queue", num=len(ids))
+            pending_bugs.extend(ids)
+
+            if please_stop:
+                break
+            # THE NEXT PAGE MAY HAVE MORE WITH THE SAME max_value
+            max_value = coalesce(_max_value(hits), max_value)
+            _progress(pending_bugs, checkpoint, slice_index, max_value)
+        else:
+            # EVERYTHING IN THE SLICE IS PENDING
+            if until != None:
+                _progress(pending_bugs, checkpoint, slice_index, until)
+            elif max_value != None:
+                _progress(pending_bugs, checkpoint, slice_index, _after(max_value))
 
         Log.note("No more ids")
     except Exception, e:
@@ -146,160 +480,593 @@ def diff(source, destination, pending, please_stop):
         return
 
     # FIND source MIN/MAX
-    results_max = source.search({
-        "query": {"match_all": {}},
-        "from": 0,
-        "size": 1,
-        "sort": {config.primary_field: "desc"}
-    })
+    _min, _max = get_range(source)
+    if _min == None:
+        return
 
-    results_min = source.search({
-        "query": {"match_all": {}},
-        "from": 0,
-        "size": 1,
-        "sort": {config.primary_field: "asc"}
-    })
+    is_string = isinstance(_min, basestring)
+    num_threads = coalesce(config.diff_threads, 4)
+    # THE source HAS THE RAW VALUES, SO THE FIXES MUST BE APPLIED BEFORE COMPARING
+    fixer = Fixer({k: f for k, f in wrap(config.fix).items() if k in _diff_fields()})
 
-    if results_max.hits.total == 0:
-        return
+    # RANGES ARE SHARED BY ALL WORKERS, SO NO WORKER IS STUCK WITH A BIG SUBTREE
+    ranges = Queue("diff ranges", silent=True)
+    locker = Lock("diff ranges")
+    remaining = [1]  # RANGES IN QUEUE, OR BEING VERIFIED
+    ranges.add((_min, None))
 
-    _min = results_min.hits.hits[0]._source[config.primary_field]
-    _max = results_max.hits.hits[0]._source[config.primary_field]
+    def worker(please_stop):
+        for min_, max_ in ranges:
+            try:
+                if please_stop:
+                    continue
+                halves = _verify(source, destination, pending, min_, max_, is_string, fixer)
+                with locker:
+                    remaining[0] += len(halves)
+                ranges.extend(halves)
+            except Exception, e:
+                Log.warning("Scanning from {{min}} to {{max}} had a problem", min=min_, max=max_, cause=e)
+            finally:
+                with locker:
+                    remaining[0] -= 1
+                    done = remaining[0] == 0
+                if done:
+                    for _ in range(num_threads):
+                        ranges.add(THREAD_STOP)
 
-    def _copy(min_, max_):
-        try:
-            if please_stop:
-                Log.note("Scanning was aborted")
-                return
+    try:
+        threads = [
+            Thread.run("diff " + unicode(i), worker, please_stop=please_stop)
+            for i in range(num_threads)
+        ]
+        for t in threads:
+            t.join()
+        if please_stop:
+            Log.note("Scanning was aborted")
+    finally:
+        Log.note("Done scanning for holes")
 
-            source_result = source.search({
-                "query": {"filtered": {
-                    "query": {"match_all": {}},
-                    "filter": {"range": {config.primary_field: {"gte": min_, "lt": max_}}}
-                }},
-                "fields": ["_id"],
-                "from": 0,
-                "size": 200000
-            })
-            source_ids = set(source_result.hits.hits._id)
 
-            destination_result = destination.search({
-                "query": {"filtered": {
-                    "query": {"match_all": {}},
-                    "filter": {"range": {config.primary_field: {"gte": min_, "lt": max_}}}
-                }},
-                "fields": ["_id"],
+def _verify(source, destination, pending, min_, max_, is_string, fixer):
+    """
+    COMPARE THE FINGERPRINTS OF min_ <= primary_field < max_ IN BOTH CLUSTERS
+    COMPARE THE DOCUMENTS WHEN THE RANGE IS SMALL
+    :return: THE HALVES STILL TO BE VERIFIED
+    """
+    source_print, destination_print = _in_parallel(
+        lambda: _fingerprint(source, min_, max_, is_string),
+        lambda: _fingerprint(destination, min_, max_, is_string)
+    )
+
+    if _same_fingerprint(source_print, destination_print):
+        return []
+
+    total = MAX([source_print.count, destination_print.count])
+    if total <= DIFF_LEAF_SIZE:
+        _compare(source, destination, pending, min_, max_, fixer)
+        return []
+
+    # SPLIT WHERE THE DATA IS, NOT WHERE THE RANGE IS
+    mid_ = _midpoint(
+        MIN([source_print.min, destination_print.min]),
+        MAX([source_print.max, destination_print.max])
+    )
+    if mid_ == None:
+        # ALL THE SAME VALUE
+        _compare(source, destination, pending, min_, max_, fixer)
+        return []
+
+    # WORK BACKWARDS
+    return [(mid_, max_), (min_, mid_)]
+
+
+def _midpoint(low, high):
+    """
+    :return: mid SUCH THAT low < mid <= high, OR None IF THERE IS NONE
+    """
+    low, high = unwraplist(low), unwraplist(high)
+    if low == None or high == None or not low < high:
+        return None
+    if Math.is_number(low) and Math.is_number(high):
+        mid = (low + high) / 2
+        if Math.is_integer(low) and Math.is_integer(high):
+            mid = int(Math.ceiling(mid))
+        if low < mid <= high:
+            return mid
+        return None
+    if isinstance(low, basestring) and isinstance(high, basestring):
+        # FIRST CHARACTER THAT DIFFERS IS SPLIT IN HALF
+        n = len(os.path.commonprefix([low, high]))
+        l = ord(low[n]) if n < len(low) else -1
+        h = ord(high[n])
+        return high[:n] + unichr((l + h + 1) // 2)
+    return None
+
+
+def _in_parallel(*functions):
+    """
+    RUN ALL functions AT THE SAME TIME
+    :return: LIST OF RESULTS
+    """
+    results = [None] * len(functions)
+
+    def _run(i, please_stop):
+        results[i] = functions[i]()
+
+    threads = [
+        Thread.run("parallel " + unicode(i), _run, i)
+        for i in range(1, len(functions))
+    ]
+    results[0] = functions[0]()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _diff_fields():
+    return [config.primary_field] + listwrap(config.diff_fields)
+
+
+def _fixed_fields():
+    """
+    FIELDS CHANGED BY config.fix, THEIR source STATS CAN NOT BE COMPARED TO destination
+    """
+    return set(k for k, _ in wrap(config.fix).items())
+
+
+def _fingerprint(es, min_, max_, is_string):
+    """
+    SUMMARY OF THE RECORDS IN min_ <= primary_field < max_
+    :return: count, min AND max OF primary_field, AND stats FOR EACH OF THE
+             NUMERIC diff_fields
+    """
+    fields = listwrap(config.diff_fields) if is_string else _diff_fields()
+    fixed = _fixed_fields()
+    query = {
+        "query": {"filtered": {
+            "query": {"match_all": {}},
+            "filter": _range_filter(min_, max_)
+        }},
+        "size": 0,
+        "aggs": {
+            "f" + unicode(i): {"stats": {"field": f}}
+            for i, f in enumerate(fields)
+        }
+    }
+    result = es.search(query)
+    output = wrap({
+        "count": result.hits.total,
+        "stats": [result.aggregations["f" + unicode(i)] for i, _ in enumerate(fields)],
+        "fixed": [f in fixed for f in fields]
+    })
+
+    if not is_string:
+        output.min = output.stats[0].min
+        output.max = output.stats[0].max
+    elif output.count:
+        # STRINGS HAVE NO stats, SO LOOK AT EACH END
+        for name, direction in [("min", "asc"), ("max", "desc")]:
+            hits = es.search({
+                "query": query["query"],
+                "fields": [config.primary_field],
                 "from": 0,
-                "size": 200000
-            })
-            destination_ids = set(destination_result.hits.hits._id)
+                "size": 1,
+                "sort": {config.primary_field: direction}
+            }).hits.hits
+            output[name] = unwraplist(hits[0].fields[literal_field(config.primary_field)])
+    return output
 
-            missing = source_ids - destination_ids
-            Log.note(
-                "Scan from {{min}} to {{max}}:  source={{source}}, dest={{dest}}, diff={{diff}}",
-                min=min_,
-                max=max_,
-                source=len(source_ids),
-                dest=len(destination_ids),
-                diff=len(missing)
-            )
 
-            if missing:
-                pending.extend(missing)
+def _same_fingerprint(a, b):
+    if a.count != b.count:
+        return False
+    for s, d, fixed in zip(a.stats, b.stats, a.fixed):
+        if fixed:
+            # ONLY _compare() CAN FIX THE source VALUES
+            continue
+        if s.count != d.count or s.min != d.min or s.max != d.max:
+            return False
+        # SHARDS ADD IN DIFFERENT ORDER, SO ALLOW FOR ROUNDING
+        if abs(coalesce(s.sum, 0) - coalesce(d.sum, 0)) > abs(coalesce(s.sum, 0)) * 1e-12:
+            return False
+    return True
+
+
+def _compare(source, destination, pending, min_, max_, fixer):
+    """
+    SEND THE IDS OF source RECORDS THAT ARE MISSING, OR DIFFERENT, IN destination
+    :param fixer: THE FIXES TO THE diff_fields, APPLIED TO THE source RECORDS BEFORE COMPARING
+    """
+    query = {
+        "query": {"filtered": {
+            "query": {"match_all": {}},
+            "filter": _range_filter(min_, max_)
+        }},
+        "fields": ["_id"] + _diff_fields(),
+        "size": BATCH_SIZE
+    }
+
+    def values(es, query):
+        # THE RANGE CAN HOLD MORE THAN ONE SEARCH CAN RETURN
+        return {
+            h._id: tuple(unwraplist(h.fields[literal_field(f)]) for f in _diff_fields())
+            for hits in es.scroll(query)
+            for h in hits
+        }
+
+    def fixed_values(es, query):
+        hits = [h for hits in es.scroll(query) for h in hits]
+        fixer([h._source for h in hits])
+        return {
+            h._id: tuple(unwraplist(h._source[f]) for f in _diff_fields())
+            for h in hits
+        }
+
+    if fixer.fixes:
+        source_query = {k: v for k, v in query.items() if k != "fields"}
+        get_source_values = lambda: fixed_values(source, source_query)
+    else:
+        get_source_values = lambda: values(source, query)
+
+    source_values, destination_values = _in_parallel(
+        get_source_values,
+        lambda: values(destination, query)
+    )
+
+    missing = [i for i, v in source_values.items() if destination_values.get(i) != v]
+    Log.note(
+        "Scan from {{min}} to {{max}}:  source={{source}}, dest={{dest}}, diff={{diff}}",
+        min=min_,
+        max=max_,
+        source=len(source_values),
+        dest=len(destination_values),
+        diff=len(missing)
+    )
+    if missing:
+        pending.extend(missing)
+
+
+class Checkpoint(object):
+    """
+    DURABLE RECORD OF HOW FAR EACH SLICE HAS BEEN REPLICATED:  ALL SLICE
+    RECORDS WITH primary_field BELOW done ARE ACKNOWLEDGED BY destination
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.locker = Lock("checkpoint")
+        self.slices = []
+
+    def load(self):
+        """
+        :return: THE (since, until) RANGES STILL TO BE REPLICATED, OR None IF NO CHECKPOINT
+        """
+        if not self.file.exists:
+            return None
+        try:
+            slices = convert.json2value(self.file.read()).slices
         except Exception, e:
-            if min_ + 1 == max_:
-                Log.warning("Scanning had a with field {{value||quote}} problem", value=min_, cause=e)
-            else:
-                mid_ = Math.round((min_+max_)/2, decimal=0)
-                _copy(min_, mid_)
-                _copy(mid_, max_)
+            Log.warning("Can not read checkpoint {{file}}", file=self.file.abspath, cause=e)
+            return None
+
+        output = [
+            (s.done, s.until)
+            for s in slices
+            if s.until == None or s.done == None or s.done < s.until
+        ]
+        if not output:
+            return None
+        return output
 
-    num_mismatches = [0]  # TRACK NUMBER OF MISMATCHES DURING REPLICATION
+    def start(self, slices):
+        with self.locker:
+            self.slices = [{"since": since, "until": until, "done": since} for since, until in slices]
+            self._write()
 
-    def _partition(min_, max_):
+    def mark(self, slice_index, value):
+        with self.locker:
+            self.slices[slice_index]["done"] = value
+            self._write()
+
+    def _write(self):
+        # WRITE TO THE SIDE, THEN RENAME, SO A CRASH LEAVES THE OLD CHECKPOINT
+        temp = self.file.abspath + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(convert.value2json({"slices": self.slices, "timestamp": Date.now()}).encode("utf8"))
+            # THE CONTENT MUST BE ON DISK BEFORE THE RENAME IS, OR A CRASH CAN LEAVE AN EMPTY CHECKPOINT
+            f.flush()
+            os.fsync(f.fileno())
         try:
-            source_count = source.search({
-                "query": {"filtered": {
-                    "query": {"match_all": {}},
-                    "filter": {"range": {config.primary_field: {"gte": min_, "lt": max_}}}
-                }},
-                "size": 0
-            })
+            os.rename(temp, self.file.abspath)
+        except OSError:
+            # WINDOWS WILL NOT RENAME OVER AN EXISTING FILE
+            os.remove(self.file.abspath)
+            os.rename(temp, self.file.abspath)
 
-            if num_mismatches[0] < 10:
-                # SOMETIMES THE TWO ARE TOO DIFFERENT TO BE OPTIMISTIC
-                dest_count = destination.search({
-                    "query": {"filtered": {
-                        "query": {"match_all": {}},
-                        "filter": {"range": {config.primary_field: {"gte": min_, "lt": max_}}}
-                    }},
-                    "size": 0
-                })
 
-                if source_count.hits.total == dest_count.hits.total:
-                    return
-                elif source_count.hits.total < 200000:
-                    num_mismatches[0] += 1
-
-            if source_count.hits.total < 200000:
-                _copy(min_, max_)
-            elif Math.is_number(min_) and Math.is_number(max_):
-                mid_ = int(round((float(min_) + float(max_)) / 2, 0))
-                # WORK BACKWARDS
-                _partition(mid_, max_)
-                _partition(min_, mid_)
-            else:
-                Log.error("can not split alphabetical in half")
-        except Exception, e:
-            Log.error("Scanning had a problem", cause=e)
+class Progress(object):
+    """
+    PLACED IN THE PENDING QUEUE, AFTER THE ids IT ACCOUNTS FOR
+    """
+    __slots__ = ["checkpoint", "slice_index", "value"]
 
-    try:
-        _partition(_min, _max)
-    finally:
-        Log.note("Done scanning for holes")
+    def __init__(self, checkpoint, slice_index, value):
+        self.checkpoint = checkpoint
+        self.slice_index = slice_index
+        self.value = value
+
+    def done(self):
+        self.checkpoint.mark(self.slice_index, self.value)
 
 
-def replicate(source, destination, pending_ids, fixes, please_stop):
+def _after_all(num, callback):
     """
-    COPY source RECORDS TO destination
+    :return: FUNCTION THAT CALLS callback ON THE num-TH CALL
+    """
+    locker = Lock("after all")
+    count = [0]
+
+    def output():
+        with locker:
+            count[0] += 1
+            ready = count[0] == num
+        if ready:
+            callback()
+
+    return output
+
+
+class FixStats(object):
+    """
+    HOW ONE fix EXPRESSION IS DOING
+    """
+    __slots__ = ["name", "expression", "count", "failures", "ignored", "seconds", "error"]
+
+    def __init__(self, name, expression):
+        self.name = name
+        self.expression = expression
+        self.count = 0
+        self.failures = 0
+        self.ignored = 0
+        self.seconds = 0
+        self.error = None
+
+    def fail(self, e):
+        e = Except.wrap(e)
+        if "Problem pulling pushlog" in e:
+            self.ignored += 1
+        elif "can not find branch" in e:
+            self.ignored += 1
+        else:
+            self.failures += 1
+            if self.error is None:
+                self.error = e
+
+    def add(self, other):
+        self.count += other.count
+        self.failures += other.failures
+        self.ignored += other.ignored
+        self.seconds += other.seconds
+
+
+class Fixer(object):
+    """
+    THE config.fix EXPRESSIONS, COMPILED ONCE INTO A FUNCTION THAT FIXES A
+    WHOLE BATCH OF _source.  EXPRESSIONS REFER TO _source PROPERTIES BY NAME
     """
 
-    def fixer(_source):
-        for k, v in _source.items():
-            locals()[k] = v
+    def __init__(self, fixes):
+        self.fixes = [(k, f) for k, f in wrap(fixes).items()]
+        self.locker = Lock("fixer stats")
+        self.totals = [FixStats(k, f) for k, f in self.fixes]
 
-        for k, f in fixes.items():
+        # PROPERTY NAMES USED BY THE EXPRESSIONS (NOT IN FIX_NAMESPACE), NOT ATTRIBUTES
+        namespace = set(FIX_NAMESPACE.keys()) | {"hg"}
+        variables = set()
+        uses_hg = []
+        for i, (k, f) in enumerate(self.fixes):
             try:
-                _source[k] = eval(f)
+                names = set(n.id for n in ast.walk(ast.parse(f, k, "eval")) if isinstance(n, ast.Name))
             except Exception, e:
-                if "Problem pulling pushlog" in e:
-                    pass
-                elif "can not find branch" in e:
-                    pass
-                else:
-                    Log.warning("not evaluated {{expression}}", expression=f, cause=e)
+                Log.error("Can not compile fix for {{name}}: {{expression}}", name=k, expression=f, cause=e)
+            variables |= set(n for n in names if n not in namespace)
+            if "hg" in names:
+                uses_hg.append(i)
 
-        return _source
+        self.function = _compile_fixes(self.fixes, variables)
+        # THE fix EXPRESSIONS THAT CALL hg, RUN FIRST TO SEE WHICH REVISIONS THE BATCH NEEDS
+        self.prefetch = _compile_fixes([self.fixes[i] for i in uses_hg], variables, prefetch=True) if uses_hg else None
 
-    for g, docs in jx.groupby(pending_ids, max_size=BATCH_SIZE):
+    def __call__(self, docs):
+        """
+        FIX THE _source OF ALL docs, IN PLACE
+        """
+        if not self.fixes:
+            return
+        if self.prefetch and hg:
+            recorder = _RevisionRecorder()
+            self.prefetch(docs, None, recorder)
+            for locale, revisions in recorder.revisions.items():
+                hg.get_revisions(revisions, locale=locale)
+
+        stats = [FixStats(k, f) for k, f in self.fixes]
+        self.function(docs, stats, hg)
+
+        for s, t in zip(stats, self.totals):
+            s.count = len(docs)
+            with self.locker:
+                t.add(s)
+            if s.failures:
+                Log.warning(
+                    "{{num}} of {{total}} documents not fixed by {{name}} = {{expression}}",
+                    num=s.failures,
+                    total=s.count,
+                    name=s.name,
+                    expression=s.expression,
+                    cause=s.error
+                )
+
+    def report(self):
+        for t in self.totals:
+            Log.note(
+                "{{name}} = {{expression}}: {{count}} documents in {{seconds|round(places=3)}} seconds, {{failures}} failures, {{ignored}} ignored",
+                name=t.name,
+                expression=t.expression,
+                count=t.count,
+                seconds=t.seconds,
+                failures=t.failures,
+                ignored=t.ignored
+            )
+
+
+def _compile_fixes(fixes, variables, prefetch=False):
+    """
+    :param fixes: LIST OF (name, expression) PAIRS
+    :param variables: _source PROPERTIES TO BIND, BY NAME
+    :param prefetch: True TO ONLY EVALUATE THE EXPRESSIONS, IGNORING ERRORS
+    :return: FUNCTION(docs, stats, hg)
+    """
+    code = (
+        "def _fix_batch(_docs, _stats, hg):\n" +
+        "    for _source in _docs:\n" +
+        "".join(
+            "        " + v + " = wrap(_source.get(" + convert.value2quote(v) + "))\n"
+            for v in sorted(variables)
+        ) +
+        "        _start = _time()\n"
+    )
+    for i, (k, f) in enumerate(fixes):
+        if prefetch:
+            code += (
+                "        try:\n" +
+                "            " + f + "\n" +
+                "        except Exception:\n" +
+                "            pass\n"
+            )
+        else:
+            code += (
+                "        try:\n" +
+                "            _source[" + convert.value2quote(k) + "] = " + f + "\n" +
+                "        except Exception as _e:\n" +
+                "            _stats[" + unicode(i) + "].fail(_e)\n" +
+                "        _end = _time()\n" +
+                "        _stats[" + unicode(i) + "].seconds += _end - _start\n" +
+                "        _start = _end\n"
+            )
+    scope = {}
+    exec code in dict(FIX_NAMESPACE, Exception=Exception, _time=_time), scope
+    return scope["_fix_batch"]
+
+
+class _RevisionRecorder(object):
+    """
+    STAND-IN FOR hg, TO RECORD THE REVISIONS A BATCH WILL ASK FOR
+    """
+
+    def __init__(self):
+        self.revisions = {}  # MAP FROM locale TO LIST OF revisions
+
+    def get_revision(self, revision, locale=None):
+        self.revisions.setdefault(locale, []).append(revision)
+        return Null
+
+
+def replicate(source, destination, pending_ids, fixer, please_stop):
+    """
+    COPY source RECORDS TO destination
+    """
+
+    if config.bulk_in_flight:
+        # KEEP bulk_in_flight BULK REQUESTS GOING TO destination WHILE WE
+        # FETCH THE NEXT BATCH.  WHEN ES REJECTS (429) THE QUEUES FILL AND
+        # THIS THREAD BLOCKS
+        if destination.adaptive_batch:
+            # EACH WRITER PUSHES WHAT IT HAS EVERY SECOND, Throttled.extend()
+            # CUTS IT INTO BULK REQUESTS OF THE CURRENT adaptive_batch.size
+            batch_size = destination.adaptive_batch.settings.max_size
+        else:
+            batch_size = BATCH_SIZE
+        writers = [
+            destination.threaded_queue(batch_size=batch_size, max_size=batch_size * 2, silent=True)
+            for _ in range(config.bulk_in_flight)
+        ]
+    else:
+        writers = None
+
+    try:
+        _replicate(source, destination, writers, pending_ids, fixer, please_stop)
+    finally:
+        for w in listwrap(writers):
+            w.stop()
+
+    fixer.report()
+    Log.note("Done replication")
+
+
+def _batches(pending_ids, destination):
+    """
+    GROUP pending_ids INTO BATCHES; THE BATCH SIZE IS LEARNED BY THE
+    destination WHEN IT HAS adaptive_batch, OTHERWISE IT IS BATCH_SIZE
+    """
+    adaptive_batch = destination.adaptive_batch
+    if not adaptive_batch:
+        for g, docs in jx.groupby(pending_ids, max_size=BATCH_SIZE):
+            yield g, docs
+        return
+
+    g = 0
+    docs = []
+    for d in pending_ids:
+        docs.append(d)
+        if len(docs) >= adaptive_batch.size:
+            yield g, wrap(docs)
+            g += 1
+            docs = []
+    if docs:
+        yield g, wrap(docs)
+
+
+def _replicate(source, destination, writers, pending_ids, fixer, please_stop):
+    for g, docs in _batches(pending_ids, destination):
         with Timer("Replicate {{num_docs}} documents", {"num_docs": len(docs)}):
-            data = source.search({
-                "query": {"filtered": {
-                    "query": {"match_all": {}},
-                    "filter": {"terms": {"_id": set(docs)}}
-                }},
-                "from": 0,
-                "size": 200000,
-                "sort": []
-            })
+            progress = [d for d in docs if isinstance(d, Progress)]
+            # single_pass HITS ALREADY HAVE _source, ONLY THE ids NEED A FETCH
+            hits = [d for d in docs if not isinstance(d, (basestring, Progress))]
+            ids = list(set(d for d in docs if isinstance(d, basestring)))
+            for i in range(0, len(ids), elasticsearch.MAX_RESULT_WINDOW):
+                some_ids = ids[i:i + elasticsearch.MAX_RESULT_WINDOW]
+                hits.extend(source.search_stream({
+                    "query": {"filtered": {
+                        "query": {"match_all": {}},
+                        "filter": {"terms": {"_id": some_ids}}
+                    }},
+                    "from": 0,
+                    "size": len(some_ids),
+                    "sort": []
+                }))
 
-            destination.extend([{"id": h._id, "value": fixer(h._source)} for h in data.hits.hits])
+            if fixer.fixes:
+                fixer([h._source for h in hits])
+                records = [{"id": h._id, "value": h._source} for h in hits]
+            else:
+                # NOTHING TO FIX, SO THE _source CAN GO STRAIGHT TO BYTES
+                records = [{"id": h._id, "json": json.dumps(unwrap(h._source), separators=(",", ":"))} for h in hits]
+            if writers:
+                writers[g % len(writers)].extend(records)
+                # DONE ONLY WHEN ALL WRITERS HAVE PUSHED WHAT THEY WERE GIVEN BEFORE
+                for p in progress:
+                    done = _after_all(len(writers), p.done)
+                    for w in writers:
+                        w.add(done)
+            else:
+                if records:
+                    destination.extend(records)
+                for p in progress:
+                    p.done()
 
         if please_stop:
             break
 
-    Log.note("Done replication")
-
 
 def main():
     global BATCH_SIZE
@@ -311,63 +1078,127 @@ def main():
     source = elasticsearch.Index(config.source)
     destination = elasticsearch.Cluster(config.destination).get_or_create_index(config.destination)
 
+    if config.batch_size:
+        BATCH_SIZE = config.batch_size
+
+    checkpoint = Checkpoint(File(coalesce(config.checkpoint, config.last_replication_time + ".checkpoint")))
+
     # GET LAST UPDATED
+    slices = None
     if config.since != None:
         last_updated = Date(config.since).unix
     else:
-        last_updated = get_last_updated(destination)
-
-    if config.batch_size:
-        BATCH_SIZE = config.batch_size
+        slices = checkpoint.load()
+        if slices:
+            Log.note("Resume from checkpoint: {{slices|json}}", slices=slices)
+            if config.slices != None and config.slices != len(slices):
+                Log.note(
+                    "Checkpoint has {{num}} slices left, config.slices={{slices}} is ignored until they are done",
+                    num=len(slices),
+                    slices=config.slices
+                )
+        else:
+            last_updated = get_last_updated(destination)
 
-    Log.note("updating records with {{primary_field}}>={{last_updated}}", last_updated=last_updated,
-             primary_field=config.primary_field)
+    if not slices:
+        Log.note("updating records with {{primary_field}}>={{last_updated}}", last_updated=last_updated,
+                 primary_field=config.primary_field)
+        slices = get_slices(source, last_updated, coalesce(config.slices, 1))
+        if len(slices) > 1:
+            Log.note("Replicate in {{num}} slices: {{slices|json}}", num=len(slices), slices=slices)
+    checkpoint.start(slices)
 
+    # SIGTERM (AND CTRL-C) STOP THE THREADS, SO bulk_load_mode CAN RESTORE THE destination SETTINGS
     please_stop = Signal()
     done = Signal()
 
-    pending = Queue("pending ids", max=BATCH_SIZE*3, silent=False)
+    def stop(signum, frame):
+        please_stop.go()
 
-    pending_thread = Thread.run(
-        "get pending",
-        get_pending,
-        source=source,
-        since=last_updated,
-        pending_bugs=pending,
-        please_stop=please_stop
-    )
-    diff_thread = Thread.run(
-        "diff",
-        diff,
-        source,
-        destination,
-        pending,
-        please_stop=please_stop
-    )
-    replication_thread = Thread.run(
-        "replication",
-        replicate,
-        source,
-        destination,
-        pending,
-        config.fix,
-        please_stop=please_stop
-    )
-    pending_thread.join()
-    diff_thread.join()
-    pending.add(THREAD_STOP)
-    try:
-        replication_thread.join()
-    except Exception, e:
-        Log.warning("Replication thread failed", cause=e)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    with bulk_load_mode(source, destination, slices):
+
+        # BY DEFAULT, EVERY READER AND WRITER GETS ITS OWN PERMIT
+        diff_threads = 0 if config.diff == False else coalesce(config.diff_threads, 4)
+        source_readers = len(slices) * 2 + diff_threads  # pending SCAN AND replicate FETCH, FOR EACH SLICE
+        destination_writers = len(slices) * MAX([1, coalesce(config.bulk_in_flight, 0)]) + diff_threads
+        source = Throttled(source, Throttle("source", coalesce(config.source_concurrency, source_readers)))
+        destination = Throttled(destination, Throttle("destination", coalesce(config.destination_concurrency, destination_writers)))
+
+        fixer = Fixer(config.fix)
+        pipelines = []
+        for i, (since, until) in enumerate(slices):
+            pending = Queue("pending ids " + unicode(i), max=BATCH_SIZE*3, silent=False)
+
+            pending_thread = Thread.run(
+                "get pending " + unicode(i),
+                get_pending_by_scroll if config.scroll else get_pending,
+                source=source,
+                since=since,
+                until=until,
+                pending_bugs=pending,
+                checkpoint=checkpoint,
+                slice_index=i,
+                please_stop=please_stop
+            )
+            replication_thread = Thread.run(
+                "replication " + unicode(i),
+                replicate,
+                source,
+                destination,
+                pending,
+                fixer,
+                please_stop=please_stop
+            )
+            pipelines.append((pending, pending_thread, replication_thread))
+
+        # THE HOLES FOUND ARE SENT TO THE FIRST PIPELINE
+        diff_thread = Thread.run(
+            "diff",
+            diff,
+            source,
+            destination,
+            pipelines[0][0],
+            please_stop=please_stop
+        )
+        for _, pending_thread, _ in pipelines:
+            _join(pending_thread)
+        _join(diff_thread)
+        for pending, _, _ in pipelines:
+            pending.add(THREAD_STOP)
+        for _, _, replication_thread in pipelines:
+            try:
+                _join(replication_thread)
+            except Exception, e:
+                Log.warning("Replication thread failed", cause=e)
     done.go()
+    stopped_early = bool(please_stop)
     please_stop.go()
 
     Log.note("done all")
+    Log.note("http connection reuse: {{stats|json}}", stats=http.pool_stats())
+    Log.note("source nodes: {{stats|json}}", stats=source.cluster.node_stats())
+    Log.note("destination nodes: {{stats|json}}", stats=destination.cluster.node_stats())
+    Log.note("http request compression: {{stats|json}}", stats=http.zip_stats())
     # RECORD LAST UPDATED, IF WE DID NOT CANCEL OUT
+    if stopped_early:
+        Log.note("Stopped early, {{file}} is not updated", file=time_file.abspath)
+        return
     time_file.write(unicode(current_time.milli))
 
 
+def _join(thread):
+    """
+    SAME AS thread.join(), BUT WAKES EVERY SECOND, BECAUSE PYTHON ONLY
+    RUNS SIGNAL HANDLERS WHEN THE MAIN THREAD IS NOT BLOCKED
+    """
+    while not thread.stopped:
+        (thread.stopped | Till(seconds=1)).wait()
+    return thread.join()
+
+
 def start():
     global hg
     global config
@@ -0,0 +1,69 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import json
+
+from mo_dots import wrap
+from mo_testing.fuzzytestcase import FuzzyTestCase
+
+from pyLibrary.env.elasticsearch import Index, bulk_failures
+
+
+def fake_index(responses, retry_items=1):
+    """
+    AN Index THAT ANSWERS EACH BULK REQUEST WITH THE NEXT LIST OF ITEM STATUS
+    """
+    index = object.__new__(Index)
+    index.settings = wrap({"index": "test", "retry_items": retry_items, "read_only": False})
+    index.dead_letter = None
+    index.debug = False
+    index.requests = []
+
+    def _bulk_post(data_bytes, num):
+        lines = str(data_bytes).strip().split(b"\n")
+        index.requests.append([json.loads(a)["index"]["_id"] for a in lines[::2]])
+        return wrap([{"index": {"status": s, "error": None if s < 300 else "error " + unicode(s)}} for s in responses.pop(0)])
+
+    index._bulk_post = _bulk_post
+    return index
+
+
+class TestBulk(FuzzyTestCase):
+
+    def test_all_ok(self):
+        index = fake_index([[201, 200]])
+        result = index.extend([{"id": "a", "value": {"a": 1}}, {"id": "b", "json": '{"b":2}'}])
+        self.assertEqual(result.ok, 2)
+        self.assertEqual(result.failed, [])
+
+    def test_only_busy_items_sent_again(self):
+        index = fake_index([[201, 429, 201], [201]])
+        result = index.extend([{"id": i, "value": {"v": i}} for i in ["a", "b", "c"]])
+        self.assertEqual(index.requests, [["a", "b", "c"], ["b"]])
+        self.assertEqual(result.ok, 3)
+        self.assertEqual(result.retried, 1)
+
+    def test_every_failure_on_exception(self):
+        index = fake_index([[400, 201, 429, 400, 503, 400], [429, 201]])
+        try:
+            index.extend([{"id": i, "value": {"v": i}} for i in ["a", "b", "c", "d", "e", "f"]])
+            self.fail("expecting an exception")
+        except Exception as e:
+            failed = bulk_failures(e)
+
+        self.assertEqual(
+            sorted((f.position, f.id, f.status) for f in failed),
+            [(0, "a", 400), (2, "c", 429), (3, "d", 400), (5, "f", 400)]
+        )
+
+    def test_not_about_documents(self):
+        self.assertEqual(bulk_failures(Exception("connection refused")), None)
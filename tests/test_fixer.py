@@ -0,0 +1,49 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import wrap
+from mo_testing.fuzzytestcase import FuzzyTestCase
+
+from replicate import Fixer
+
+
+class TestFixer(FuzzyTestCase):
+
+    def test_fix(self):
+        fixer = Fixer({"bug": "int(bug)", "starttime": "float(starttime)"})
+        docs = [wrap({"bug": "3", "starttime": "1.5"}), wrap({"bug": 4, "starttime": 2})]
+        fixer(docs)
+        self.assertEqual(docs, [{"bug": 3, "starttime": 1.5}, {"bug": 4, "starttime": 2.0}])
+        self.assertEqual(fixer.totals[0].count, 2)
+
+    def test_attribute_is_not_a_property(self):
+        fixer = Fixer({"push": "wrap(run).suite"})
+        docs = [wrap({"run": {"suite": "mochitest"}, "suite": "wrong"})]
+        fixer(docs)
+        self.assertEqual(docs[0].push, "mochitest")
+
+    def test_property_named_like_a_global(self):
+        fixer = Fixer({"total": "int(id) + int(hash) + len(type)"})
+        docs = [wrap({"id": 1, "hash": 2, "type": "abc"})]
+        fixer(docs)
+        self.assertEqual(docs[0].total, 6)
+
+    def test_failure_is_counted(self):
+        fixer = Fixer({"bug": "int(bug)"})
+        docs = [wrap({"bug": "not a number"}), wrap({"bug": "7"})]
+        fixer(docs)
+        self.assertEqual(docs[0].bug, "not a number")
+        self.assertEqual(docs[1].bug, 7)
+        self.assertEqual(fixer.totals[0].failures, 1)
+
+    def test_bad_expression(self):
+        self.assertRaises("Can not compile fix for bug", Fixer, {"bug": "int(bug"})
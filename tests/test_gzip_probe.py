@@ -0,0 +1,68 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import wrap
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Lock
+
+from pyLibrary.env.elasticsearch import Cluster
+
+
+def fake_cluster(responses):
+    """
+    A Cluster THAT ANSWERS EACH PROBE WITH THE NEXT (status_code, content)
+    """
+    cluster = object.__new__(Cluster)
+    cluster.settings = wrap({"host": "http://localhost", "port": 9200})
+    cluster.path = "http://localhost:9200"
+    cluster._zip = None
+    cluster._zip_locker = Lock("zip probe")
+    cluster.calls = []
+
+    def _call(method, path, **kwargs):
+        cluster.calls.append((path, kwargs["headers"]["Content-Encoding"]))
+        status_code, content = responses.pop(0)
+        return wrap({"status_code": status_code, "all_content": content})
+
+    cluster._call = _call
+    return cluster
+
+
+class TestGzipProbe(FuzzyTestCase):
+
+    def test_accepted(self):
+        cluster = fake_cluster([(200, b'{"hits":{"total":0}}')])
+        self.assertEqual(cluster.can_zip("/test/_bulk"), True)
+        self.assertEqual(cluster.can_zip("/test/_search"), True)
+        self.assertEqual(cluster.calls, [("/test/_search?size=0", "gzip")])
+
+    def test_refused(self):
+        cluster = fake_cluster([(400, b'{"error":"bad request"}')])
+        self.assertEqual(cluster.can_zip("/test/_bulk"), False)
+        self.assertEqual(cluster.can_zip("/test/_bulk"), False)
+        self.assertEqual(len(cluster.calls), 1)
+
+    def test_error_in_body(self):
+        cluster = fake_cluster([(200, b'{"error":"can not parse"}')])
+        self.assertEqual(cluster.can_zip("/test/_bulk"), False)
+
+    def test_missing_index_asks_again(self):
+        cluster = fake_cluster([(404, b'{"error":"no such index"}'), (200, b'{}')])
+        self.assertEqual(cluster.can_zip("/test/_bulk"), False)
+        self.assertEqual(cluster.can_zip("/test/_bulk"), True)
+        self.assertEqual(len(cluster.calls), 2)
+
+    def test_no_index_no_probe(self):
+        cluster = fake_cluster([])
+        self.assertEqual(cluster.can_zip("/_cluster/health"), False)
+        self.assertEqual(cluster.can_zip("/"), False)
+        self.assertEqual(cluster.calls, [])
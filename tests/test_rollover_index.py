@@ -0,0 +1,163 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import json
+
+from mo_dots import wrap
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Lock, Queue
+
+from pyLibrary import convert
+from pyLibrary.env import rollover_index
+from pyLibrary.env.rollover_index import _fix_line, _fix_decoded_line, RolloverIndex, _PeriodQueue
+
+TEST_RESULT = wrap({"name": "active-data-test-result"})
+OTHER = wrap({"name": "other"})
+
+
+class TestFixLine(FuzzyTestCase):
+
+    def assertSameFix(self, line, source=OTHER):
+        _id, fixed = _fix_line(line, source)
+        expected_id, expected = _fix_decoded_line(line, source)
+        self.assertEqual(_id, expected_id)
+        self.assertEqual(json.loads(fixed), json.loads(expected))
+        return _id, json.loads(fixed)
+
+    def test_drop_resource_usage(self):
+        _id, value = self.assertSameFix('{"_id": "a", "resource_usage": {"cpu": [1, 2]}, "run": {"x": "a,b"}}')
+        self.assertEqual(_id, "a")
+        self.assertEqual(value, {"_id": "a", "run": {"x": "a,b"}})
+        self.assertFalse("resource_usage" in value)
+
+    def test_drop_last_resource_usage(self):
+        _, value = self.assertSameFix('{"_id": "a", "run": 1, "resource_usage" : null }')
+        self.assertFalse("resource_usage" in value)
+
+    def test_add_revision12(self):
+        _, value = self.assertSameFix('{"_id": "a", "build": {"revision": "0123456789abcdef"}, "resource_usage": 1}')
+        self.assertEqual(value["build"]["revision12"], "0123456789ab")
+
+    def test_keep_revision12(self):
+        _, value = self.assertSameFix('{"_id": "a", "build": {"revision12": "x", "revision": "y"}, "resource_usage": 1}')
+        self.assertEqual(value["build"]["revision12"], "x")
+
+    def test_unwrap_repo(self):
+        _, value = self.assertSameFix('{"_id": "a", "repo": {"_source": {"branch": "b"}}, "resource_usage": 1}')
+        self.assertEqual(value["repo"], {"branch": "b"})
+
+    def test_name_inside_string(self):
+        _, value = self.assertSameFix('{"_id": "a", "message": "said \\"build\\": no", "build": {"revision": "abc"}, "resource_usage": 1}')
+        self.assertEqual(value["message"], 'said "build": no')
+
+    def test_nested_name(self):
+        _, value = self.assertSameFix('{"_id": "a", "run": {"build": 1}, "build": {"revision": "abc"}, "resource_usage": 1}')
+        self.assertEqual(value["run"], {"build": 1})
+        self.assertEqual(value["build"]["revision12"], "abc")
+
+    def test_shorten(self):
+        line = json.dumps({
+            "_id": "b",
+            "result": {"subtests": [{"ok": True, "name": "x" * 100}] * (rollover_index.MAX_RECORD_LENGTH // 100) + [{"ok": False, "name": "y"}]},
+            "repo": {"changeset": {"files": ["f"], "id": "c"}},
+            "resource_usage": {"a": 1}
+        })
+        _, value = self.assertSameFix(line, TEST_RESULT)
+        self.assertEqual(value["result"], {"subtests": [{"ok": False, "name": "y"}], "missing_subtests": True})
+        self.assertEqual(value["repo"], {"changeset": {"id": "c"}})
+
+
+class FakeIndex(object):
+    """
+    ACCEPTS THE DOCUMENTS, EXCEPT THE ids IN reject, WHICH FAIL WITH THE GIVEN STATUS
+    """
+
+    def __init__(self, reject=None):
+        self.settings = wrap({"index": "test"})
+        self.reject = reject or {}
+        self.sent = []
+
+    def extend(self, docs):
+        failed = [
+            {"position": i, "id": d["id"], "status": self.reject[d["id"]], "error": "rejected", "line": d["json"]}
+            for i, d in enumerate(docs)
+            if d["id"] in self.reject
+        ]
+        self.sent.extend(d["id"] for d in docs if d["id"] not in self.reject)
+        self.reject = {}  # ONLY THE FIRST TIME
+        if failed:
+            Log.error("Problems with insert", failed=failed)
+
+
+def fake_rollover(batch_size=10):
+    """
+    A RolloverIndex WITH NO CLUSTER, AND NO THREADS
+    """
+    owner = object.__new__(RolloverIndex)
+    owner.settings = wrap({"index": "test", "batch_size": batch_size, "queue_size": 1000, "queue_bytes": 1000000})
+    owner.locker = Lock()
+    owner.budget_locker = Lock()
+    owner.known_queues = {}
+    owner.resident_docs = 0
+    owner.resident_bytes = 0
+    owner.to_flush = Queue("to flush", unique=True, silent=True)
+    return owner
+
+
+class TestPeriodQueue(FuzzyTestCase):
+
+    def test_budget_and_callbacks(self):
+        owner = fake_rollover()
+        index = FakeIndex()
+        queue = _PeriodQueue(owner, index, 0)
+        done = []
+
+        queue.extend([{"id": "a", "json": '{"a":1}'}, {"id": "b", "value": {"b": 2}}])
+        queue.add(lambda: done.append(True))
+        self.assertEqual(owner.resident_docs, 2)
+        self.assertEqual(owner.resident_bytes, len('{"a":1}') + len(convert.value2json({"b": 2})))
+        self.assertEqual(done, [])
+
+        self.assertEqual(queue.flush(), True)
+        self.assertEqual(index.sent, ["a", "b"])
+        self.assertEqual(owner.resident_docs, 0)
+        self.assertEqual(owner.resident_bytes, 0)
+        self.assertEqual(done, [True])
+
+    def test_full_batch_is_flushed(self):
+        owner = fake_rollover(batch_size=2)
+        queue = _PeriodQueue(owner, FakeIndex(), 0)
+        queue.extend([{"id": "a", "json": "{}"}])
+        self.assertEqual(len(owner.to_flush), 0)
+        queue.extend([{"id": "b", "json": "{}"}])
+        self.assertEqual(len(owner.to_flush), 1)
+
+    def test_only_retryable_kept(self):
+        owner = fake_rollover()
+        index = FakeIndex(reject={"a": 400, "b": 429})
+        queue = _PeriodQueue(owner, index, 0)
+        done = []
+        queue.extend([{"id": i, "json": "{}"} for i in ["a", "b", "c"]])
+        queue.add(lambda: done.append(True))
+
+        self.assertEqual(queue.flush(), False)
+        self.assertEqual(index.sent, ["c"])
+        self.assertEqual([d["id"] for d in queue.buffer], ["b"])
+        self.assertEqual(owner.resident_docs, 1)
+        self.assertEqual(owner.resident_bytes, 2)
+        self.assertEqual(done, [])
+
+        self.assertEqual(queue.flush(), True)
+        self.assertEqual(index.sent, ["c", "b"])
+        self.assertEqual(owner.resident_docs, 0)
+        self.assertEqual(done, [True])
@@ -0,0 +1,62 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import Data, wrap
+from mo_testing.fuzzytestcase import FuzzyTestCase
+
+from replicate import Throttle, Throttled
+
+
+class FakeIndex(object):
+    """
+    RECORD EACH BULK REQUEST, AND SHRINK THE BATCH AFTER THE FIRST ONE
+    """
+
+    def __init__(self, sizes, fail_id=None):
+        self.sizes = sizes
+        self.fail_id = fail_id
+        self.requests = []
+        self.adaptive_batch = Data(size=sizes[0])
+
+    def extend(self, records):
+        self.requests.append([r["id"] for r in records])
+        if self.adaptive_batch:
+            self.adaptive_batch.size = self.sizes[min(len(self.requests), len(self.sizes) - 1)]
+        failed = [
+            {"position": i, "id": r["id"], "status": 400}
+            for i, r in enumerate(records)
+            if r["id"] == self.fail_id
+        ]
+        return wrap({"ok": len(records) - len(failed), "retried": 0, "failed": failed})
+
+
+class TestThrottled(FuzzyTestCase):
+
+    def test_extend_uses_current_size(self):
+        index = FakeIndex([4, 2])
+        destination = Throttled(index, Throttle("test", 1))
+        destination.extend([{"id": i} for i in range(8)])
+        self.assertEqual(index.requests, [[0, 1, 2, 3], [4, 5], [6, 7]])
+
+    def test_extend_merges_results(self):
+        index = FakeIndex([3], fail_id=4)
+        destination = Throttled(index, Throttle("test", 1))
+        result = destination.extend([{"id": i} for i in range(5)])
+        self.assertEqual(result.ok, 4)
+        self.assertEqual(result.failed, [{"position": 4, "id": 4, "status": 400}])
+
+    def test_no_adaptive_batch(self):
+        index = FakeIndex([3])
+        index.adaptive_batch = None
+        destination = Throttled(index, Throttle("test", 1))
+        destination.extend([{"id": i} for i in range(5)])
+        self.assertEqual(index.requests, [[0, 1, 2, 3, 4]])
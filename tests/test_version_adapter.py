@@ -0,0 +1,84 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import wrap, literal_field, unwraplist
+from mo_testing.fuzzytestcase import FuzzyTestCase
+
+from pyLibrary import convert
+from pyLibrary.env.elasticsearch import VersionAdapter
+
+
+class TestVersionAdapter(FuzzyTestCase):
+
+    def test_v1_query_unchanged(self):
+        query = {"query": {"filtered": {"filter": {"and": [{"term": {"a": 1}}]}}}, "fields": ["_id", "a"]}
+        self.assertEqual(VersionAdapter("1.7.5").query(query), query)
+
+    def test_unknown_version_is_v1(self):
+        self.assertEqual(VersionAdapter(None).major, 1)
+
+    def test_v5_bool_filters(self):
+        query = VersionAdapter("5.6.0").query({
+            "query": {"filtered": {
+                "query": {"match_all": {}},
+                "filter": {"and": [{"term": {"a": 1}}, {"missing": {"field": "b"}}]}
+            }}
+        })
+        self.assertEqual(query.query, {"bool": {"filter": {"bool": {"filter": [
+            {"term": {"a": 1}},
+            {"bool": {"must_not": {"exists": {"field": "b"}}}}
+        ]}}}})
+        self.assertEqual(query.query.bool.must, None)
+
+    def test_v5_fields_become_source(self):
+        query = VersionAdapter("5.6.0").query({"query": {"match_all": {}}, "fields": ["_id", "etl.timestamp"]})
+        self.assertEqual(query.fields, None)
+        self.assertEqual(query._source, ["etl.timestamp"])
+
+    def test_v5_hit_dotted_field(self):
+        adapter = VersionAdapter("5.6.0")
+        query = wrap({"fields": ["_id", "etl.timestamp", "bug_id"]})
+        hit = adapter.hit(query, wrap({"_id": "1", "_source": {"etl": {"timestamp": 42}, "bug_id": 7}}))
+        self.assertEqual(unwraplist(hit.fields[literal_field("etl.timestamp")]), 42)
+        self.assertEqual(unwraplist(hit.fields[literal_field("bug_id")]), 7)
+
+    def test_v7_tracks_total_hits(self):
+        self.assertEqual(VersionAdapter("7.1.0").query({"query": {"match_all": {}}}).track_total_hits, True)
+        self.assertEqual(VersionAdapter("6.8.0").query({"query": {"match_all": {}}}).track_total_hits, None)
+
+    def test_v7_total(self):
+        result = VersionAdapter("7.1.0").response(wrap({}), wrap({"hits": {"total": {"value": 3, "relation": "eq"}, "hits": []}}))
+        self.assertEqual(result.hits.total, 3)
+
+    def test_scroll_next(self):
+        params, data = VersionAdapter("1.7.5").scroll_next("5m", "abc")
+        self.assertEqual(params, {"scroll": "5m"})
+        self.assertEqual(data, b"abc")
+
+        params, data = VersionAdapter("5.6.0").scroll_next("5m", "abc")
+        self.assertEqual(params, None)
+        self.assertEqual(convert.json2value(data.decode("utf8")), {"scroll": "5m", "scroll_id": "abc"})
+
+    def test_clear_scroll(self):
+        path, data = VersionAdapter("1.7.5").clear_scroll("abc")
+        self.assertEqual(path, "/_search/scroll/abc")
+        self.assertEqual(data, None)
+
+        path, data = VersionAdapter("6.0.0").clear_scroll("abc")
+        self.assertEqual(path, "/_search/scroll")
+        self.assertEqual(convert.json2value(data.decode("utf8")), {"scroll_id": ["abc"]})
+
+    def test_sliced_scroll_needs_v5(self):
+        self.assertRaises("Sliced scroll needs ES 5", VersionAdapter("2.4.0").scroll, {"query": {"match_all": {}}}, (0, 2))
+        query = VersionAdapter("5.6.0").scroll({"query": {"match_all": {}}}, (0, 2))
+        self.assertEqual(query.slice, {"id": 0, "max": 2})
+        self.assertEqual(query.sort, ["_doc"])